@@ -3,6 +3,10 @@
 
 # My imports
 from __future__ import division, print_function
+import os
+import glob
+import time
+from multiprocessing import Pool
 import numpy as np
 from astropy.io import fits
 import argparse
@@ -14,18 +18,51 @@ def _parser():
     '''The argparse stuff'''
 
     parser = GooeyParser(description='CRIRES spectrum to an 1D spectrum')
-    parser.add_argument('fname', action='store', widget='FileChooser', help='Input fits file')
+    parser.add_argument('fname', action='store', nargs='+', widget='MultiFileChooser',
+                        help='Input fits file(s). Folders (e.g. all the spectra'
+                        ' of a night) and glob patterns are also accepted')
     parser.add_argument('--output', default=False,
-                        help='Output to this name. If nothing is given, output will be: "wmin-wmax.fits"')
+                        help='Output to this name. If nothing is given, output will be: "wmin-wmax.fits"'
+                        ' (only used for a single file with a single chip)')
+    parser.add_argument('--outdir', default=False,
+                        help='Convert all chips of all files to this folder'
+                        ' as "<fname>_<chip>.fits"')
     parser.add_argument('-u', '--unit', default='angstrom',
                         choices=['angstrom', 'nm'],
                         help='The unit of the output wavelength')
     parser.add_argument('-c', '--clobber', default=True, action='store_false',
                         help='Do not overwrite existing files.')
+    parser.add_argument('-p', '--processes', default=None, type=int,
+                        help='Number of processes for many files (default: number of CPUs)')
     args = parser.parse_args()
     return args
 
 
+def _wavelength(d, column, hdr, unit=1):
+    '''Get the wavelength of a chip from its data and header. The pipeline
+    spectrum (Extracted_OPT) uses the grid from ESO INS WLEN MIN/MAX in the
+    header, and a Dracs reduction (Extracted_DRACS) its Wavelength column.
+
+    Input:
+        d: Data of the chip
+        column: The flux column (Extracted_OPT or Extracted_DRACS)
+        hdr: Header of the chip
+        unit: 1=Aangstrom, 2=nm
+    Output:
+        w: Output wavelength
+    '''
+    if column == 'Extracted_DRACS':
+        w = np.asarray(d['Wavelength'], dtype=float)
+    else:
+        I = d[column]
+        wmin, wmax = hdr['ESO INS WLEN MIN'], hdr['ESO INS WLEN MAX']
+        w = np.linspace(wmin, wmax, len(I), endpoint=True)
+    if unit == 1:
+        return w * 10
+    elif unit == 2:
+        return w
+
+
 def _get_wavelength(fname, unit=1):
     '''Get the wavelength from a CRIRES pipeline reduced spectrum.
 
@@ -35,14 +72,127 @@ def _get_wavelength(fname, unit=1):
     Output:
         w: Output wavelength
     '''
-    d = fits.getdata(fname)
-    hdr = fits.getheader(fname)
-    I = d['Extracted_OPT']
-    wmin, wmax = hdr['ESO INS WLEN MIN'], hdr['ESO INS WLEN MAX']
-    if unit == 1:
-        return np.linspace(wmin, wmax, len(I), endpoint=True) * 10
-    elif unit == 2:
-        return np.linspace(wmin, wmax, len(I), endpoint=True)
+    with fits.open(fname, memmap=False) as hdulist:
+        _, d, column, hdr = _chips(hdulist)[0]
+        return _wavelength(d, column, hdr, unit=unit)
+
+
+def _chips(hdulist):
+    '''The extensions with an extracted spectrum (one for each chip).
+
+    Input:
+        hdulist: The opened fits file
+    Output:
+        chips: List of (extension, data, flux column, header)
+    '''
+    chips = []
+    for ext, hdu in enumerate(hdulist):
+        if not isinstance(hdu, fits.BinTableHDU):
+            continue
+        names = hdu.columns.names
+        for column in ('Extracted_OPT', 'Extracted_DRACS'):
+            if column in names:
+                hdr = hdulist[0].header.copy()
+                hdr.extend(hdu.header, update=True)
+                chips.append((ext, hdu.data, column, hdr))
+                break
+    return chips
+
+
+def _write(output, w, I, clobber=True):
+    '''Write a 1D spectrum with the wavelength in the header. A wavelength
+    which is not linear (e.g. from Dracs) is resampled to a linear grid
+    first, since the header only has CRVAL1 and CDELT1'''
+    N = len(w)
+    if not np.allclose(np.diff(w), (w[-1] - w[0]) / (N - 1)):
+        w_lin = np.linspace(w[0], w[-1], N, endpoint=True)
+        I = np.interp(w_lin, w, I)
+        w = w_lin
+    hdr = fits.Header()
+    hdr["NAXIS1"] = N
+    hdr["CDELT1"] = (w[-1]-w[0])/N
+    hdr["CRVAL1"] = w[0]
+    fits.writeto(output, np.asarray(I), header=hdr, overwrite=clobber)
+
+
+def convert(fname, outdir='.', unit=1, clobber=True):
+    '''Convert all chips of a CRIRES spectrum to 1D spectra. The file is only
+    opened once.
+
+    Input:
+        fname: Fits file of CRIRES spectrum
+        outdir: Folder for the output. The output is "<fname>_<chip>.fits"
+        unit: Unit of wavelength vector (Angstrom is default.)
+        clobber: Overwrite existing files
+    Output:
+        outputs: The names of the output files
+    '''
+    base = os.path.splitext(os.path.basename(fname))[0]
+    outputs = []
+    with fits.open(fname, memmap=False) as hdulist:
+        for ext, d, column, hdr in _chips(hdulist):
+            w = _wavelength(d, column, hdr, unit=unit)
+            output = os.path.join(outdir, '{0!s}_{1:d}.fits'.format(base, ext))
+            _write(output, w, d[column], clobber=clobber)
+            outputs.append(output)
+    if not outputs:
+        raise ValueError('No extracted spectrum found in {0!s}'.format(fname))
+    return outputs
+
+
+def _convert_job(job):
+    '''Convert a single file in a worker and time it'''
+    fname, kwargs = job
+    t0 = time.time()
+    try:
+        outputs = convert(fname, **kwargs)
+        return fname, outputs, time.time() - t0, None
+    except Exception as e:
+        return fname, [], time.time() - t0, '{0!s}'.format(e)
+
+
+def batch(fnames, outdir='.', unit=1, clobber=True, processes=None):
+    '''Convert all chips of many CRIRES spectra (e.g. a night) in a process
+    pool. Failed files are reported, but do not stop the run.
+
+    Input:
+        fnames: Fits files, folders or glob patterns
+        outdir: Folder for the output
+        unit: Unit of wavelength vector (Angstrom is default.)
+        clobber: Overwrite existing files
+        processes: Number of processes (default: number of CPUs)
+    Output:
+        failed: Dictionary with the error for each failed file
+    '''
+    files = []
+    for fname in fnames:
+        if os.path.isdir(fname):
+            files += sorted(glob.glob(os.path.join(fname, '*.fits')))
+        else:
+            files += sorted(glob.glob(fname)) or [fname]
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    kwargs = {'outdir': outdir, 'unit': unit, 'clobber': clobber}
+    jobs = [(fname, kwargs) for fname in files]
+
+    t0 = time.time()
+    failed = {}
+    pool = Pool(processes)
+    try:
+        for i, (fname, outputs, t, error) in enumerate(pool.imap_unordered(_convert_job, jobs)):
+            if error is None:
+                print('{0:d}/{1:d} {2!s}: {3:d} chips in {4:.2f}s'.format(i + 1, len(jobs), fname, len(outputs), t))
+            else:
+                failed[fname] = error
+                print('{0:d}/{1:d} {2!s}: FAILED after {3:.2f}s ({4!s})'.format(i + 1, len(jobs), fname, t, error))
+    finally:
+        pool.close()
+        pool.join()
+
+    print('{0:d} files converted in {1:.1f}s, {2:d} failed'.format(len(files) - len(failed), time.time() - t0, len(failed)))
+    for fname in sorted(failed):
+        print('  {0!s}: {1!s}'.format(fname, failed[fname]))
+    return failed
 
 
 def main(fname, output=False, unit=1, clobber=True):
@@ -54,21 +204,16 @@ def main(fname, output=False, unit=1, clobber=True):
         unit: Unit of wavelength vector (Angstrom is default.)
         clobber: Overwrite existing files
     '''
-    I = fits.getdata(fname)
-    w = _get_wavelength(fname, unit=unit)
+    with fits.open(fname, memmap=False) as hdulist:
+        _, I, column, hdr = _chips(hdulist)[0]
+        w = _wavelength(I, column, hdr, unit=unit)
     if not output:
-        output = '{0:d}-{1:d}.fits'.format(w.min(), w.max())
+        output = '{0:d}-{1:d}.fits'.format(int(w.min()), int(w.max()))
     else:
         if not output.lower().endswith('.fits'):
             output += '.fits'
 
-    N = len(w)
-    hdr = fits.Header()
-    hdr["NAXIS1"] = N
-    hdr["CDELT1"] = (w[-1]-w[0])/N
-    hdr["CRVAL1"] = w[0]
-
-    fits.writeto(output, I['Extracted_OPT'], header=hdr, clobber=clobber)
+    _write(output, w, I[column], clobber=clobber)
     print('File writed to: {0!s}'.format(output))
 
 
@@ -78,4 +223,8 @@ if __name__ == '__main__':
         args.unit = 1
     elif args.unit == 'nm':
         args.unit = 2
-    main(args.fname, output=args.output, unit=args.unit, clobber=args.clobber)
+    if len(args.fname) == 1 and not args.outdir and not os.path.isdir(args.fname[0]):
+        main(args.fname[0], output=args.output, unit=args.unit, clobber=args.clobber)
+    else:
+        batch(args.fname, outdir=args.outdir or '.', unit=args.unit,
+              clobber=args.clobber, processes=args.processes)
@@ -5,10 +5,199 @@ from __future__ import print_function
 from astropy.io import fits
 import numpy as np
 from scipy.interpolate import interp1d
+from itertools import islice
+import os
 import argparse
 
 
-def convert2fits(fname, fout=None, dA=0.01, unit='a', read=True):
+def _read_chunks(fname, chunksize=1000000):
+    """Read the first two columns of an ASCII file in chunks. pandas is used
+    as a fast reader if it is available.
+
+    :fname: File name of ASCII
+    :chunksize: Number of rows in each chunk
+    :returns: Generator with the wavelength and flux of each chunk
+    """
+    try:
+        import pandas as pd
+    except ImportError:
+        with open(fname) as f:
+            while True:
+                lines = list(islice(f, chunksize))
+                if not lines:
+                    break
+                d = np.loadtxt(lines, usecols=(0, 1), ndmin=2)
+                if len(d):
+                    yield d[:, 0], d[:, 1]
+        return
+    reader = pd.read_csv(fname, sep=r'\s+', header=None, usecols=[0, 1],
+                         comment='#', chunksize=chunksize, engine='c')
+    for d in reader:
+        d = d.values.astype(float)
+        yield d[:, 0], d[:, 1]
+
+
+def _last_wavelength(fname):
+    """The wavelength in the last row of an ASCII file, without reading the
+    whole file"""
+    with open(fname, 'rb') as f:
+        f.seek(0, 2)
+        size = f.tell()
+        block = 4096
+        while True:
+            f.seek(max(size - block, 0))
+            lines = [l for l in f.read().splitlines() if l.strip() and not l.startswith(b'#')]
+            if len(lines) > 1 or block >= size:
+                return float(lines[-1].split()[0])
+            block *= 2
+
+
+def convert2fits_stream(fname, fout=None, dA=0.01, unit='a', chunksize=1000000):
+    """Convert a 2-column ASCII to fits format like convert2fits, but read,
+    resample and write the spectrum in chunks, so the memory used does not
+    depend on the size of the file. The wavelength must be increasing.
+
+    :fname: File name of ASCII. First column is wavelength and second column is
+    intensity.
+    :fout: Output name. By default it returns the output is the ASCII name with
+    a fits extension.
+    :dA: The wavelength step. 0.01 Angstrom by default.
+    :chunksize: Number of rows read at a time
+    """
+    if not fout:
+        fout = fname.rpartition('.')[0] + '.fits'
+    scale = 10 if unit == 'n' else 1
+
+    chunks = _read_chunks(fname, chunksize=chunksize)
+    ll, flux = next(chunks)
+    ll0 = ll[0] * scale
+    N = int((_last_wavelength(fname) * scale - ll0) / dA)
+
+    prihdr = fits.Header()
+    prihdr['SIMPLE'] = True
+    prihdr['BITPIX'] = -64
+    prihdr['NAXIS'] = 1
+    prihdr["NAXIS1"] = N
+    prihdr["CDELT1"] = dA
+    prihdr["CRVAL1"] = ll0
+    # StreamingHDU appends to an existing file, so overwrite it like
+    # convert2fits does
+    if os.path.exists(fout):
+        os.remove(fout)
+    shdu = fits.StreamingHDU(fout, prihdr)
+
+    # The last point of a chunk is kept for the interpolation across the edge
+    # to the next chunk
+    k = 0
+    last = np.array([]), np.array([])
+    while k < N:
+        ll = np.concatenate((last[0], ll * scale))
+        flux = np.concatenate((last[1], flux))
+        k1 = min(int(np.floor((ll[-1] - ll0) / dA)) + 1, N)
+        if k1 > k:
+            ll_int = np.arange(k, k1) * dA + ll0
+            shdu.write(np.interp(ll_int, ll, flux).astype('>f8'))
+            k = k1
+        last = ll[-1:], flux[-1:]
+        try:
+            ll, flux = next(chunks)
+        except StopIteration:
+            break
+    if k < N:  # Should not happen for a well-formed file, but keep it valid
+        shdu.write(np.full(N - k, np.nan, dtype='>f8'))
+    shdu.close()
+
+
+def _first_wavelength(fname):
+    """The wavelength in the first row of an ASCII file"""
+    with open(fname) as f:
+        for line in f:
+            if line.strip() and not line.startswith('#'):
+                return float(line.split()[0])
+
+
+def convert2container(fnames, fout, dA=0.01, unit='a', wmin=None, wmax=None):
+    """Convert many 2-column ASCII spectra to a single fits file. The spectra
+    are resampled to the same wavelength grid and written as rows of an image
+    (CRVAL1/CDELT1 as for a 1D spectrum), one spectrum at a time. The INDEX
+    extension has the name (the ASCII name without extension) and row of each
+    spectrum. See read_container.
+
+    :fnames: File names of ASCII. First column is wavelength and second column
+    is intensity.
+    :fout: Output name
+    :dA: The wavelength step. 0.01 Angstrom by default.
+    :unit: Unit of wavelength vector (a or n)
+    :wmin: First wavelength of the grid (default: the first wavelength of the
+    spectrum starting last)
+    :wmax: Last wavelength of the grid (default: the last wavelength of the
+    spectrum ending first)
+    :returns: Dictionary with the row of each spectrum
+    """
+    scale = 10 if unit == 'n' else 1
+    if wmin is None:
+        wmin = max(_first_wavelength(fname) for fname in fnames) * scale
+    if wmax is None:
+        wmax = min(_last_wavelength(fname) for fname in fnames) * scale
+    N = int((wmax - wmin) / dA)
+    if N <= 0:
+        raise ValueError('The spectra do not have a common wavelength range')
+    ll_int = np.arange(N) * dA + wmin
+
+    prihdr = fits.Header()
+    prihdr['SIMPLE'] = True
+    prihdr['BITPIX'] = -64
+    prihdr['NAXIS'] = 2
+    prihdr["NAXIS1"] = N
+    prihdr["NAXIS2"] = len(fnames)
+    prihdr["CDELT1"] = dA
+    prihdr["CRVAL1"] = wmin
+    # StreamingHDU and fits.append add to an existing file, so the container
+    # is written to a new file and renamed over the old one at the end
+    ftmp = '{0!s}.{1:d}.tmp'.format(fout, os.getpid())
+    if os.path.exists(ftmp):
+        os.remove(ftmp)
+    try:
+        shdu = fits.StreamingHDU(ftmp, prihdr)
+        names = []
+        for fname in fnames:
+            ll, flux = np.loadtxt(fname, usecols=(0, 1), unpack=True)
+            shdu.write(np.interp(ll_int, ll * scale, flux, left=np.nan, right=np.nan).astype('>f8'))
+            names.append(os.path.splitext(os.path.basename(fname))[0])
+        shdu.close()
+
+        index = fits.BinTableHDU.from_columns([
+            fits.Column(name='NAME', format='{0:d}A'.format(max(map(len, names))), array=names),
+            fits.Column(name='ROW', format='J', array=np.arange(len(names)))], name='INDEX')
+        fits.append(ftmp, index.data, index.header)
+        os.rename(ftmp, fout)
+    finally:
+        if os.path.exists(ftmp):
+            os.remove(ftmp)
+    return dict(zip(names, range(len(names))))
+
+
+def read_container(fname, name):
+    """Read a single spectrum from a file made with convert2container. The
+    file is memory mapped, so only this spectrum is read.
+
+    :fname: File name of the container
+    :name: Name of the spectrum
+    :returns: The wavelength and flux
+    """
+    with fits.open(fname, memmap=True) as hdulist:
+        index = hdulist['INDEX'].data
+        rows = index['ROW'][index['NAME'] == name]
+        if not len(rows):
+            raise KeyError('{0!s} is not in {1!s}'.format(name, fname))
+        hdr = hdulist[0].header
+        flux = np.array(hdulist[0].section[int(rows[0])])
+    w0, dw, n = hdr['CRVAL1'], hdr['CDELT1'], hdr['NAXIS1']
+    return np.linspace(w0, w0 + dw * n, n, endpoint=False), flux
+
+
+def convert2fits(fname, fout=None, dA=0.01, unit='a', read=True, stream=False,
+                 chunksize=1000000):
     """Convert a 2-column ASCII to fits format for splot@IRAF or ARES.
 
     :fname: File name of ASCII. First column is wavelength and second column is
@@ -18,7 +207,11 @@ def convert2fits(fname, fout=None, dA=0.01, unit='a', read=True):
     :dA: The wavelength step. 0.01 Angstrom by default.
     :read: If True, the data will be read from file, fname. If False, fname
     should contain the wavelength and flux vector
+    :stream: Read and write the file in chunks (see convert2fits_stream)
+    :chunksize: Number of rows read at a time in the streaming mode
     """
+    if read and stream:
+        return convert2fits_stream(fname, fout, dA, unit, chunksize=chunksize)
 
     if not fout:
         fout = fname.rpartition('.')[0] + '.fits'
@@ -46,12 +239,19 @@ def _parser():
     parser = argparse.ArgumentParser(description='Convert a 2-column ASCII'
                                      'with wavelength and intensity to a 1D'
                                      'spectra for splot@IRAF or ARES')
-    parser.add_argument('input', help='File name of ASCII file')
+    parser.add_argument('input', help='File name of ASCII file. With several'
+                        ' files and --container, all files are written to a'
+                        ' single fits file',
+                        nargs='+')
     parser.add_argument('-o', '--output',
                         help='File name of output. Default'
                         ' is the ASCII name with a .fits'
                         ' extension',
                         default=None)
+    parser.add_argument('--container',
+                        help='Write all spectra on the same wavelength grid to'
+                        ' this single fits file',
+                        default=None)
     parser.add_argument('-d', '--delta',
                         help='Wavelength step (default: 0.01A)',
                         default=0.01,
@@ -59,6 +259,15 @@ def _parser():
     parser.add_argument('-u', '--unit',
                         help='Unit of wavelength vector (default: AA)',
                         default='a')
+    parser.add_argument('-s', '--stream',
+                        help='Read and write the file in chunks (for very'
+                        ' large files)',
+                        action='store_true')
+    parser.add_argument('--chunksize',
+                        help='Number of rows read at a time with --stream'
+                        ' (default: 1000000)',
+                        default=1000000,
+                        type=int)
     args = parser.parse_args()
     return args
 
@@ -69,4 +278,10 @@ if __name__ == '__main__':
     if args.unit not in ('a', 'n'):
         raise ValueError(r'Unit can be a (Å) or n (nm)')
 
-    convert2fits(args.input, args.output, args.delta, args.unit)
+    if args.container:
+        convert2container(args.input, args.container, args.delta, args.unit)
+    else:
+        for fname in args.input:
+            convert2fits(fname, args.output if len(args.input) == 1 else None,
+                         args.delta, args.unit, stream=args.stream,
+                         chunksize=args.chunksize)
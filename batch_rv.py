@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+# My imports
+from __future__ import division, print_function
+import os
+import time
+import glob
+import signal
+import argparse
+from multiprocessing import Pool
+import numpy as np
+import plot_fits
+import rvstore
+
+_REFERENCES = {}
+_STORE = {}
+
+
+def _parser():
+    parser = argparse.ArgumentParser(description='Calculate the RV of many'
+                                     ' spectra with a CCF (no plotting)')
+    parser.add_argument('fnames', nargs='+',
+                        help='Input fits files (a glob like "*.fits" is also'
+                        ' accepted)')
+    parser.add_argument('-o', '--output', default='rv_results.dat',
+                        help='The output table (default: rv_results.dat)')
+    parser.add_argument('-c', '--ccf', default='sun',
+                        choices=['sun', 'model', 'telluric', 'both', 'mask'],
+                        help='Calculate the CCF for Sun/model or tellurics '
+                        'or both, or with the line mask from --linelist.')
+    parser.add_argument('--linelist', default=False,
+                        help='Line list for the line mask CCF (MOOG format'
+                        ' from numpy2moog/linelist_filter or .dat from'
+                        ' VALDprepare)')
+    parser.add_argument('-m', '--model', default=False,
+                        help='Use this model instead of the Sun')
+    parser.add_argument('--ccf-method', default='direct',
+                        choices=['direct', 'fft', 'adaptive', 'bank'],
+                        help='Calculate the CCF directly on the RV grid, '
+                        'with an FFT on a log-lambda grid, with a '
+                        'coarse-to-fine search, or with a bank of shifted '
+                        'templates kept in ~/.plotfits/bank/.')
+    parser.add_argument('--rvmin', default=0, type=float,
+                        help='The lowest RV in km/s')
+    parser.add_argument('--rvmax', default=200, type=float,
+                        help='The highest RV in km/s')
+    parser.add_argument('--drv', default=1, type=float,
+                        help='The velocity step in km/s')
+    parser.add_argument('--norm', default='top50',
+                        choices=['top50', 'continuum', 'median'],
+                        help='Normalization of the spectra')
+    parser.add_argument('--ftype', help='Select which type the fits file is',
+                        choices=['1D', 'CRIRES', 'GIANO'], default='1D')
+    parser.add_argument('--fitsext', help='Select fits extention, Default 0.',
+                        choices=['0', '1', '2', '3', '4'], default='0')
+    parser.add_argument('--order', help='Select which GIANO order to be investigated',
+                        choices=list(map(str, range(32, 81))), default='77')
+    parser.add_argument('-p', '--processes', default=None, type=int,
+                        help='Number of processes (default: number of CPUs)')
+    parser.add_argument('-s', '--store', default=False,
+                        help='Keep the results in this SQLite file, and skip'
+                        ' the files already calculated with the same'
+                        ' parameters')
+    parser.add_argument('-w', '--watch', default=False, action='store_true',
+                        help='Keep running and calculate the RV of new fits'
+                        ' files in the folders (or glob patterns) as they'
+                        ' arrive. The results are appended to the output')
+    parser.add_argument('--interval', default=2.0, type=float,
+                        help='Seconds between looking for new files with'
+                        ' --watch (default: 2)')
+    return parser.parse_args()
+
+
+def _init_worker(ccf='sun', model=False, linelist=False, store=False):
+    """Load the reference spectra once for each worker
+
+    :ccf: Calculate CCF for (sun, model, telluric, both, mask)
+    :model: Model spectrum used instead of the Sun
+    :linelist: Line list for the line mask CCF
+    :store: SQLite file with the results (see rvstore)
+    """
+    _REFERENCES.clear()
+    _REFERENCES.update(plot_fits.load_references(
+        sun=ccf in ['sun', 'both'] and not model,
+        telluric=ccf in ['telluric', 'both'], model=model,
+        linelist=ccf == 'mask' and linelist))
+    _STORE.clear()
+    if store:
+        templates = [key for key, use in (('sun', ccf in ['sun', 'both'] and not model),
+                                          ('model', ccf in ['model', 'both'] and model),
+                                          ('telluric', ccf in ['telluric', 'both']),
+                                          ('mask', ccf == 'mask'))
+                     if use]
+        _STORE.update(db=rvstore.connect(store), templates=templates,
+                      params={'model': model, 'linelist': linelist,
+                              'telluric': ccf in ['telluric', 'both'], 'rv': False})
+
+
+def _init_watch_worker(*args):
+    """Like _init_worker, but Ctrl-C only stops the main process, so the
+    queued files are finished"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _init_worker(*args)
+
+
+def _rv_file(job):
+    """Calculate the RV of a single file with the references of the worker
+
+    :job: The file name and the keyword arguments for plot_fits.measure_rv
+    :returns: The rows for the results table
+    """
+    fname, kwargs = job
+    t0 = time.time()
+    timings = {'read': 0, 'ccf': 0}
+
+    def compute():
+        results, t = plot_fits.measure_rv(fname, _REFERENCES, **kwargs)
+        timings.update(t)
+        return results
+
+    try:
+        if _STORE:
+            params = dict(_STORE['params'], **kwargs)
+            params.pop('ccf')
+            results, stored = rvstore.cached_ccf(_STORE['db'], fname, _STORE['templates'],
+                                                 compute, **params)
+        else:
+            results, stored = compute(), False
+    except Exception as e:
+        return [(fname, '-', np.nan, np.nan, np.nan, np.nan,
+                 np.nan, np.nan, time.time() - t0, 'error: {0!s}'.format(e).replace('\t', ' '))]
+
+    rows = []
+    for key in sorted(results):
+        RV, g = results[key][0], results[key][-1]
+        parameters = plot_fits.gaussian_parameters(g)
+        # The RV is truncated to km/s, so the fit decides if it failed
+        status = 'ok' if np.isfinite(parameters[2]) else 'no CCF'
+        if stored:
+            status += ' (stored)'
+        rows.append((fname, key, RV) + parameters +
+                    (timings['read'], timings['ccf'], time.time() - t0, status))
+    if not rows:
+        rows.append((fname, '-', np.nan, np.nan, np.nan, np.nan,
+                     timings['read'], timings['ccf'], time.time() - t0,
+                     'no templates in wavelength range'))
+    return rows
+
+
+def write_results(rows, output, mode='w'):
+    """Write the rows of the results table
+
+    :rows: The rows from _rv_file
+    :output: The output file
+    :mode: 'w' to write a new table, 'a' to append to an existing table
+    """
+    with open(output, mode) as f:
+        if mode == 'w':
+            f.write('# fname\ttemplate\trv\tamplitude\tcenter\tsigma\t'
+                    't_read\tt_ccf\tt_total\tstatus\n')
+        for row in rows:
+            f.write('{0!s}\t{1!s}\t{2!s}\t{3:.4f}\t{4:.4f}\t{5:.4f}\t'
+                    '{6:.3f}\t{7:.3f}\t{8:.3f}\t{9!s}\n'.format(*row))
+
+
+def batch_rv(fnames, output='rv_results.dat', ccf='sun', model=False,
+             processes=None, linelist=False, store=False, **kwargs):
+    """Calculate the RV of many spectra in a process pool
+
+    :fnames: List of input fits files (or glob patterns)
+    :output: The output table
+    :ccf: Calculate CCF for (sun, model, telluric, both, mask)
+    :model: Model spectrum used instead of the Sun
+    :processes: Number of processes (default: number of CPUs)
+    :linelist: Line list for the line mask CCF (ccf='mask')
+    :store: Keep the results in this SQLite file (see rvstore), and skip the
+    files already calculated with the same parameters
+    :kwargs: Other keywords for plot_fits.measure_rv (ccf_method, ftype,
+    fitsext, order, rvmin, rvmax, drv, norm)
+    :returns: The rows of the results table
+    """
+    files = []
+    for fname in fnames:
+        files += sorted(glob.glob(fname)) or [fname]
+    kwargs['ccf'] = ccf
+    jobs = [(fname, kwargs) for fname in files]
+
+    t0 = time.time()
+    pool = Pool(processes, initializer=_init_worker, initargs=(ccf, model, linelist, store))
+    try:
+        results = {}
+        for i, rows in enumerate(pool.imap_unordered(_rv_file, jobs)):
+            results[rows[0][0]] = rows
+            print('{0:d}/{1:d} {2!s}: {3!s}'.format(i + 1, len(jobs), rows[0][0], rows[0][-1]))
+    finally:
+        pool.close()
+        pool.join()
+
+    rows = [row for fname in files for row in results[fname]]
+    write_results(rows, output)
+    print('{0:d} files in {1:.1f}s. Results saved in {2!s}'.format(len(files), time.time() - t0, output))
+    return rows
+
+
+def _find_files(fnames):
+    """The fits files in folders and glob patterns"""
+    files = []
+    for fname in fnames:
+        if os.path.isdir(fname):
+            files += glob.glob(os.path.join(fname, '*.fits'))
+        else:
+            files += glob.glob(fname)
+    return sorted(files)
+
+
+def watch(fnames, output='rv_results.dat', ccf='sun', model=False,
+          processes=None, linelist=False, store=False, interval=2.0, **kwargs):
+    """Calculate the RV of new spectra as they arrive, e.g. during a night.
+    The workers keep the reference spectra loaded between files, and the
+    rows of each file are appended to the output as soon as it is done.
+    Files already in the output are skipped. Stop with Ctrl-C.
+
+    :fnames: Folders (or glob patterns) to watch
+    :output: The output table
+    :ccf: Calculate CCF for (sun, model, telluric, both, mask)
+    :model: Model spectrum used instead of the Sun
+    :processes: Number of processes (default: number of CPUs)
+    :linelist: Line list for the line mask CCF (ccf='mask')
+    :store: Keep the results in this SQLite file (see rvstore)
+    :interval: Seconds between looking for new files
+    :kwargs: Other keywords for plot_fits.measure_rv (ccf_method, ftype,
+    fitsext, order, rvmin, rvmax, drv, norm)
+    """
+    done = set()
+    if os.path.isfile(output):
+        with open(output) as f:
+            done = set(line.split('\t')[0] for line in f if not line.startswith('#'))
+    else:
+        write_results([], output)
+    kwargs['ccf'] = ccf
+
+    def finished(rows):
+        write_results(rows, output, mode='a')
+        print('{0!s}: {1!s}'.format(rows[0][0], rows[0][-1]))
+
+    # A file is queued when its size has not changed since the last look, so
+    # files which are still being written are not read
+    sizes = {}
+    pool = Pool(processes, initializer=_init_watch_worker, initargs=(ccf, model, linelist, store))
+    print('Watching {0!s} (Ctrl-C to stop)...'.format(', '.join(fnames)))
+    try:
+        while True:
+            for fname in _find_files(fnames):
+                if fname in done:
+                    continue
+                try:
+                    size = os.path.getsize(fname)
+                except OSError:  # Renamed or removed since the glob
+                    sizes.pop(fname, None)
+                    continue
+                if sizes.get(fname) == size:
+                    done.add(fname)
+                    pool.apply_async(_rv_file, ((fname, kwargs),), callback=finished)
+                sizes[fname] = size
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print('Stopping, waiting for the queued files...')
+    finally:
+        pool.close()
+        pool.join()
+
+
+if __name__ == '__main__':
+    args = vars(_parser())
+    fnames = args.pop('fnames')
+    if args.pop('watch'):
+        watch(fnames, **args)
+    else:
+        args.pop('interval')
+        batch_rv(fnames, **args)
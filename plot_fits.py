@@ -4,15 +4,24 @@
 # My imports
 from __future__ import division, print_function
 import os
+import json
+import time
+import sys
+import hashlib
 import urllib
-import numpy as np
-import scipy.interpolate as sci
-import matplotlib.pyplot as plt
-import matplotlib
-from astropy.io import fits
-from astropy.modeling import models, fitting
+import contextlib
 import argparse
-from gooey import Gooey, GooeyParser
+import numpy as np
+# astropy, scipy, matplotlib and gooey are imported where they are needed,
+# to keep 'import plot_fits' cheap (see import_time)
+
+_PATH = os.path.expanduser('~/.plotfits/')
+_MODEL_CACHE_SIZE = 2000  # MB
+_BANK_SIZE = 2000  # MB
+_BANK_ROUND = 10  # Angstrom, see _template_range
+_IMPORT_TIME_BUDGET = 0.5  # seconds
+_GIANO_WAVELENGTHS = {}
+_REFINE_FIT = False  # Refine the CCF peak fit with astropy's LevMarLSQFitter
 
 
 def _download_spec(fout):
@@ -30,22 +39,161 @@ def _download_spec(fout):
 class Cursor:
     """Get a crosshair at the cursor's position
 
+    Only the two crosshair lines are redrawn when the mouse moves (blitting).
+    The static background is saved after each full draw (e.g. after a zoom or
+    pan), and motion events closer than interval seconds are skipped.
+
     The code is from here:
     http://matplotlib.org/examples/pylab_examples/cursor_demo.html
     """
 
-    def __init__(self, ax):
+    def __init__(self, ax, interval=0.02):
         self._ax = ax
-        self.lx = ax.axhline(color='b', lw=2, alpha=0.7)
-        self.ly = ax.axvline(color='b', lw=2, alpha=0.7)
+        self.lx = ax.axhline(color='b', lw=2, alpha=0.7, animated=True)
+        self.ly = ax.axvline(color='b', lw=2, alpha=0.7, animated=True)
+        self._interval = interval
+        self._last = 0
+        self._background = None
+        ax.figure.canvas.mpl_connect('draw_event', self.on_draw)
+
+    def on_draw(self, event):
+        self._background = self._ax.figure.canvas.copy_from_bbox(self._ax.bbox)
+        self._ax.draw_artist(self.lx)
+        self._ax.draw_artist(self.ly)
 
     def mouse_move(self, event):
         if not event.inaxes:
             return
+        now = time.time()
+        if now - self._last < self._interval:
+            return
+        self._last = now
         x, y = event.xdata, event.ydata
-        self.lx.set_ydata(y)
-        self.ly.set_xdata(x)
-        plt.draw()
+        self.lx.set_ydata([y, y])
+        self.ly.set_xdata([x, x])
+        canvas = self._ax.figure.canvas
+        if self._background is None or not getattr(canvas, 'supports_blit', True):
+            canvas.draw_idle()
+            return
+        canvas.restore_region(self._background)
+        self._ax.draw_artist(self.lx)
+        self._ax.draw_artist(self.ly)
+        canvas.blit(self._ax.bbox)
+
+
+class DecimatedLine:
+    """Plot a spectrum with at most a few points per screen pixel
+
+    The visible part of the full resolution spectrum is split in one bin per
+    pixel of the axes, and only the min and max of each bin are plotted (so
+    narrow lines stay visible). The line is decimated again from the full
+    resolution arrays each time the x-limits change.
+    """
+
+    def __init__(self, ax, x, y, *args, **kwargs):
+        self._ax = ax
+        self.x = np.asarray(x)
+        self.y = np.asarray(y)
+        self.line, = ax.plot(*(self._decimate(None, None) + args), **kwargs)
+        ax.callbacks.connect('xlim_changed', self.update)
+        ax.figure.canvas.mpl_connect('resize_event', self.update)
+
+    def _decimate(self, x0, x1):
+        i0 = 0 if x0 is None else max(np.searchsorted(self.x, x0) - 1, 0)
+        i1 = len(self.x) if x1 is None else np.searchsorted(self.x, x1) + 1
+        x, y = self.x[i0:i1], self.y[i0:i1]
+        nbins = max(int(self._ax.bbox.width), 1)
+        if len(x) <= 4 * nbins:
+            return x, y
+
+        # Min and max of each bin (in the original order of the points)
+        m = int(np.ceil(len(x) / nbins))
+        nbins = int(np.ceil(len(x) / m))
+        yy = np.concatenate((y, np.full(nbins * m - len(y), np.nan))).reshape(nbins, m)
+        nan = np.isnan(yy)
+        start = np.arange(nbins) * m
+        # A bin of only NaN gives its first point, so the gap stays visible
+        imin = start + np.argmin(np.where(nan, np.inf, yy), axis=1)
+        imax = start + np.argmax(np.where(nan, -np.inf, yy), axis=1)
+        idx = np.column_stack((np.minimum(imin, imax), np.maximum(imin, imax))).ravel()
+        idx = np.concatenate(([0], idx, [len(x) - 1]))
+        return x[idx], y[idx]
+
+    def update(self, event=None):
+        x0, x1 = sorted(self._ax.get_xlim())
+        self.line.set_data(*self._decimate(x0, x1))
+
+
+def _interp_batch(x, xp, fp):
+    """Linear interpolation of many rows of points in one pass.
+
+    :x: The points to evaluate (any shape)
+    :xp: The increasing x-coordinates of the data
+    :fp: The y-coordinates of the data. Several data sets on the same xp can
+    be given as a 2D array (n_data x len(xp))
+    :returns: The interpolated values with shape fp.shape[:-1] + x.shape.
+    Points outside xp are NaN
+    """
+    dx = (xp[-1] - xp[0]) / (len(xp) - 1)
+    if np.allclose(np.diff(xp), dx):
+        # Equidistant grid (e.g. from get_wavelength): no search needed
+        t = (x - xp[0]) / dx
+        i = np.clip(t.astype(int), 0, len(xp) - 2)
+        t -= i
+    else:
+        i = np.clip(np.searchsorted(xp, x), 1, len(xp) - 1) - 1
+        t = (x - xp[i]) / (xp[i + 1] - xp[i])
+    y = fp[..., i] + (fp[..., i + 1] - fp[..., i]) * t
+    y[..., (x < xp[0]) | (x > xp[-1])] = np.nan
+    return y
+
+
+def _ccf_batch(w, f, tw, tf, drvs, chunksize=2**22, bounds=None):
+    """Calculate the CCF for all velocities on the RV grid in batches.
+
+    The template shifted by a velocity rv and evaluated at the observed
+    wavelengths w is the template evaluated at w / (1 + rv/c), so the whole
+    RV grid is one (velocity x pixel) interpolation.
+
+    :w: The wavelength of the stellar spectrum
+    :f: The flux of the stellar spectrum
+    :tw: The wavelength of the template
+    :tf: The flux of the template. Several templates on the same tw can be
+    given as a 2D array (n_templates x len(tw))
+    :drvs: The RV grid in km/s
+    :chunksize: Maximum number of elements in one (velocity x pixel) block
+    :bounds: The (first, last) wavelength covered by each template. Default
+    is the range of tw
+    :returns: The CCF, and a boolean array with velocities where the shifted
+    template did not cover the spectrum (the CCF is 0 here). Both have a
+    leading template axis if tf is 2D
+    """
+    c = 299792.458
+    w = np.asarray(w, dtype=float)
+    f = np.asarray(f, dtype=float)
+    tw = np.asarray(tw, dtype=float)
+    tf = np.asarray(tf, dtype=float)
+    drvs = np.asarray(drvs, dtype=float)
+    single = tf.ndim == 1
+    tf = np.atleast_2d(tf)
+    if bounds is None:
+        bounds = [(tw[0], tw[-1])] * len(tf)
+    lo, hi = np.asarray(bounds, dtype=float).T
+    scale = 1.0 + drvs / c
+    outside = ((w.min() / scale < lo[:, np.newaxis]) |
+               (w.max() / scale > hi[:, np.newaxis]))
+    cc = np.zeros(outside.shape)
+    step = max(1, chunksize // max(1, len(w) * len(tf)))
+    for i in range(0, len(drvs), step):
+        ok = ~outside[:, i:i + step]
+        if not np.any(ok):
+            continue
+        s = scale[i:i + step]
+        fiw = _interp_batch(w[np.newaxis, :] / s[:, np.newaxis], tw, tf)
+        cc[:, i:i + step] = np.where(ok, fiw.dot(f), 0)
+    if single:
+        return cc[0], outside[0]
+    return cc, outside
 
 
 def ccf_astro(spectrum1, spectrum2, rvmin=0, rvmax=200, drv=1):
@@ -58,59 +206,636 @@ def ccf_astro(spectrum1, spectrum2, rvmin=0, rvmax=200, drv=1):
     """
 
     # Calculate the cross correlation
-    s = False
     w, f = spectrum1
     tw, tf = spectrum2
     if not len(w) or not len(tw):
         return 0, 0, 0, 0, 0
+    drvs = np.arange(rvmin, rvmax, drv)
+    cc, outside = _ccf_batch(w, f, tw, tf, drvs)
+
+    if np.any(outside):
+        print('Warning: Lower the bounds on RV')
+
+    return _ccf_result(drvs, cc)
+
+
+def ccf_multi(spectrum, templates, rvmin=0, rvmax=200, drv=1, full=False):
+    """Make the CCF between a spectrum and several templates in one pass
+
+    The templates are resampled to one common wavelength grid, so the shifted
+    observed grid is calculated once and all templates are interpolated on it
+    in the same batch.
+
+    :spectrum: The stellar spectrum
+    :templates: A dictionary (or list) of templates, e.g. sun, model, telluric
+    :rvmin: The lowest RV
+    :rvmax: The highest RV
+    :drv: The velocity step
+    :full: Also return the fitted gaussian model for each template
+    :returns: A dictionary (or list) with the output of ccf_astro for each
+    template
+    """
+    keys = list(templates.keys()) if isinstance(templates, dict) else list(range(len(templates)))
+    w, f = spectrum
+    empty = (0, 0, 0, 0, 0, None) if full else (0, 0, 0, 0, 0)
+    results = {key: empty for key in keys}
+    valid = [key for key in keys if len(templates[key][0])]
+    if len(w) and len(valid):
+        tws = [np.asarray(templates[key][0], dtype=float) for key in valid]
+        dw = min(np.median(np.diff(tw)) for tw in tws)
+        tw0 = min(tw[0] for tw in tws)
+        tw1 = max(tw[-1] for tw in tws)
+        grid = tw0 + dw * np.arange(int(np.ceil((tw1 - tw0) / dw)) + 1)
+        tf = np.array([np.interp(grid, tw, templates[key][1], left=0, right=0)
+                       for tw, key in zip(tws, valid)])
+        bounds = [(tw[0], tw[-1]) for tw in tws]
+
+        drvs = np.arange(rvmin, rvmax, drv)
+        cc, outside = _ccf_batch(w, f, grid, tf, drvs, bounds=bounds)
+        if np.any(outside):
+            print('Warning: Lower the bounds on RV')
+        for key, cci in zip(valid, cc):
+            results[key] = _ccf_result(drvs, cci, full=full)
+
+    if isinstance(templates, dict):
+        return results
+    return [results[key] for key in keys]
+
+
+def ccf_orders(w, f, templates, rvmin=0, rvmax=200, drv=1, chunksize=2**22,
+               full=False):
+    """Make the CCF of every order of an echelle spectrum with its own
+    templates in one pass
+
+    The templates of all orders are resampled to the same step and put after
+    each other on one equidistant axis, each order moved by its own offset.
+    The shifted wavelengths of all orders are then one (velocity x order x
+    pixel) interpolation, like _ccf_batch does for a single spectrum. A line
+    mask (key 'mask') uses ccf_mask for each order.
+
+    :w: The wavelength (n_orders x n_pixels)
+    :f: The flux (n_orders x n_pixels), e.g. line depths
+    :templates: A dictionary of templates (see ccf_templates) for each order
+    :rvmin: The lowest RV
+    :rvmax: The highest RV
+    :drv: The velocity step
+    :chunksize: Maximum number of elements in one (velocity x order x pixel)
+    block
+    :full: Also return the fitted gaussian model for each template
+    :returns: A dictionary with the output of ccf_astro for each template,
+    for each order
+    """
     c = 299792.458
+    w = np.asarray(w, dtype=float)
+    f = np.asarray(f, dtype=float)
     drvs = np.arange(rvmin, rvmax, drv)
-    cc = np.zeros(len(drvs))
-    for i, rv in enumerate(drvs):
-        fi = sci.interp1d(tw * (1.0 + rv / c), tf)
-        # Shifted template evaluated at location of spectrum
-        try:
-            fiw = fi(w)
-            cc[i] = np.sum(f * fiw)
-        except ValueError:
-            s = True
-            fiw = 0
-            cc[i] = 0
-
-    if s:
+    scale = 1.0 + drvs / c
+    empty = (0, 0, 0, 0, 0, None) if full else (0, 0, 0, 0, 0)
+    results = [{key: empty for key in t} for t in templates]
+    for i, t in enumerate(templates):
+        if 'mask' in t:
+            results[i]['mask'] = ccf_mask((w[i], f[i]), t['mask'], rvmin, rvmax, drv, full=full)
+
+    keys = sorted(set(key for t in templates for key in t if key != 'mask'))
+    for key in keys:
+        orders = [i for i, t in enumerate(templates) if key in t and len(t[key][0]) and len(w[i])]
+        if not orders:
+            continue
+        tws = [np.asarray(templates[i][key][0], dtype=float) for i in orders]
+        dw = min(np.median(np.diff(tw)) for tw in tws)
+        grids = [tw[0] + dw * np.arange(int(np.ceil((tw[-1] - tw[0]) / dw)) + 1) for tw in tws]
+        starts = np.cumsum([0] + [len(grid) + 1 for grid in grids[:-1]])
+        offsets = starts * dw - np.array([grid[0] for grid in grids])
+        tw = dw * np.arange(starts[-1] + len(grids[-1]))
+        tf = np.zeros(len(tw))
+        for i, start, grid, twi in zip(orders, starts, grids, tws):
+            tf[start:start + len(grid)] = np.interp(grid, twi, templates[i][key][1], left=0, right=0)
+        lo = np.array([tw[0] for tw in tws])
+        hi = np.array([tw[-1] for tw in tws])
+        wo, fo = w[orders], f[orders]
+
+        outside = ((wo.min(axis=1)[:, np.newaxis] / scale < lo[:, np.newaxis]) |
+                   (wo.max(axis=1)[:, np.newaxis] / scale > hi[:, np.newaxis]))
+        if np.any(outside):
+            print('Warning: Lower the bounds on RV')
+        cc = np.zeros(outside.shape)
+        step = max(1, chunksize // max(1, wo.size))
+        for j in range(0, len(drvs), step):
+            ok = ~outside[:, j:j + step]
+            if not np.any(ok):
+                continue
+            s = scale[j:j + step]
+            x = wo[np.newaxis] / s[:, np.newaxis, np.newaxis] + offsets[:, np.newaxis]
+            fiw = _interp_batch(x, tw, tf)
+            cc[:, j:j + step] = np.where(ok, np.einsum('vop,op->ov', fiw, fo), 0)
+        for i, cci in zip(orders, cc):
+            results[i][key] = _ccf_result(drvs, cci, full=full)
+    return results
+
+
+def loglambda_grid(wmin, wmax, dv):
+    """Equidistant grid in ln(wavelength) where a Doppler shift is a constant
+    pixel shift.
+
+    :wmin: The first wavelength
+    :wmax: The last wavelength
+    :dv: The requested velocity step in km/s
+    :returns: The ln(wavelength) grid, and the velocity resolution of one pixel
+    in km/s
+    """
+    c = 299792.458
+    dlnw = np.log(1.0 + dv / c)
+    lnw = np.arange(np.log(wmin), np.log(wmax), dlnw)
+    return lnw, c * (np.exp(dlnw) - 1.0)
+
+
+def ccf_fft(spectrum1, spectrum2, rvmin=0, rvmax=200, drv=1, full=False):
+    """Make a CCF between 2 spectra with one FFT on a log-lambda grid and find
+    the RV
+
+    Both spectra are resampled once to a common ln(wavelength) grid with the
+    sampling of the stellar spectrum (or finer if drv asks for it). The RV
+    grid is then given by the pixel size of the log-lambda grid.
+
+    :spectrum1: The stellar spectrum
+    :spectrum2: The model, sun or telluric
+    :drv: The largest velocity step allowed
+    :full: Also return the fitted gaussian model
+    :returns: The RV shift
+    """
+    w, f = spectrum1
+    tw, tf = spectrum2
+    if not len(w) or not len(tw):
+        return (0, 0, 0, 0, 0, None) if full else (0, 0, 0, 0, 0)
+    c = 299792.458
+    lnw, lntw = np.log(w), np.log(tw)
+    dv = min(c * np.median(np.diff(lnw)), drv)
+    grid, dv = loglambda_grid(min(w[0], tw[0]), max(w[-1], tw[-1]), dv)
+    print('Velocity resolution of the log-lambda grid: {0:.3f} km/s'.format(dv))
+    S = np.interp(grid, lnw, f, left=0, right=0)
+    T = np.interp(grid, lntw, tf, left=0, right=0)
+
+    # Circular correlation with enough zero padding to avoid wrap around
+    nfft = 2 ** int(np.ceil(np.log2(2 * len(grid))))
+    cc = np.fft.irfft(np.fft.rfft(S, nfft) * np.conj(np.fft.rfft(T, nfft)), nfft)
+    dlnw = np.log(1.0 + dv / c)
+    lags = np.arange(np.ceil(np.log(1.0 + rvmin / c) / dlnw),
+                     np.floor(np.log(1.0 + rvmax / c) / dlnw) + 1, dtype=int)
+    lags = lags[np.abs(lags) < len(grid)]
+    if not len(lags):
+        return (0, 0, 0, 0, 0, None) if full else (0, 0, 0, 0, 0)
+    drvs = c * (np.exp(lags * dlnw) - 1.0)
+    return _ccf_result(drvs, cc[lags % nfft], full=full)
+
+
+def _ccf_width(w, f, maxlag=200):
+    """Estimate the width (sigma in km/s) of the CCF peak from the
+    autocorrelation of the spectrum, i.e. assuming the template has lines of
+    the same width
+
+    :w: The wavelength of the stellar spectrum
+    :f: The flux of the stellar spectrum (line depths)
+    :maxlag: The largest lag in pixels
+    :returns: The width, or None if it could not be estimated
+    """
+    f = np.asarray(f, dtype=float)
+    f = f - np.mean(f)
+    n = len(f)
+    lags = np.arange(min(maxlag, n // 2))
+    acf = np.array([np.dot(f[:n - lag], f[lag:]) for lag in lags])
+    if len(acf) < 2 or acf[0] <= 0:
+        return None
+    # The lag where a gaussian falls to exp(-1/2) is its sigma
+    below = np.where(acf / acf[0] < np.exp(-0.5))[0]
+    if not len(below):
+        return None
+    i = below[0]
+    a0, a1 = acf[i - 1] / acf[0], acf[i] / acf[0]
+    lag = i - 1 + (a0 - np.exp(-0.5)) / (a0 - a1)
+    return lag * 299792.458 * np.median(np.diff(w) / w[1:])
+
+
+def ccf_adaptive(spectrum1, spectrum2, rvmin=0, rvmax=200, drv=1,
+                 coarse=20, max_step=None, npeaks=3, full=False):
+    """Make a CCF between 2 spectra with a coarse-to-fine search and find the
+    RV
+
+    The CCF is first calculated on a coarse RV grid with a step of twice the
+    width (sigma) of the CCF peak, so a coarse point is within one sigma of
+    the peak and it is not missed. Only around the highest
+    peaks of the coarse CCF is it refined down to drv. The saving is about
+    the coarse step over drv: an order of magnitude or more for a fine drv
+    (e.g. 0.1 km/s) or broad lines, but only a few times for drv=1 km/s and
+    a CCF peak of a few km/s, where the full grid is already close to the
+    resolution of the peak.
+
+    :spectrum1: The stellar spectrum
+    :spectrum2: The model, sun or telluric
+    :rvmin: The lowest RV
+    :rvmax: The highest RV
+    :drv: The velocity step of the refined CCF
+    :coarse: The largest coarse step in units of drv
+    :max_step: The largest coarse step in km/s. Default is twice the width of
+    the CCF peak estimated from the spectrum (see _ccf_width), or 5 km/s if
+    it could not be estimated
+    :npeaks: Number of candidate peaks to refine
+    :full: Also return the fitted gaussian model
+    :returns: The RV shift. The RV grid is the coarse grid with the refined
+    points around the peaks
+    """
+    w, f = spectrum1
+    tw, tf = spectrum2
+    if not len(w) or not len(tw):
+        return (0, 0, 0, 0, 0, None) if full else (0, 0, 0, 0, 0)
+
+    # Work on integer steps of drv, so the coarse and fine grids coincide
+    n = int(np.ceil((rvmax - rvmin) / drv))
+    if max_step is None:
+        width = _ccf_width(w, f)
+        max_step = 2 * width if width else 5.0
+    m = max(1, min(int(coarse), int(max_step / drv)))
+    k = np.arange(0, n, m)
+    cc, outside = _ccf_batch(w, f, tw, tf, rvmin + k * drv)
+
+    # Candidate peaks are the highest local maxima of the coarse CCF
+    c = np.concatenate(([-np.inf], np.where(outside, -np.inf, cc), [-np.inf]))
+    peaks = np.where((c[1:-1] > c[:-2]) & (c[1:-1] >= c[2:]))[0]
+    peaks = peaks[np.argsort(cc[peaks])[::-1][:npeaks]]
+    # The peak is within m/2 of a coarse maximum, and the fit needs a few
+    # points on both sides of it
+    fine = [np.arange(max(0, k[p] - m // 2 - 3), min(n, k[p] + m // 2 + 4)) for p in peaks]
+    fine = np.setdiff1d(np.concatenate([k[:0]] + fine), k)
+    cc_fine, outside_fine = _ccf_batch(w, f, tw, tf, rvmin + fine * drv)
+
+    k = np.concatenate((k, fine))
+    i = np.argsort(k)
+    cc = np.concatenate((cc, cc_fine))[i]
+    if np.any(outside) or np.any(outside_fine):
         print('Warning: Lower the bounds on RV')
+    return _ccf_result(rvmin + k[i] * drv, cc, full=full)
+
+
+@contextlib.contextmanager
+def _locked_index(folder):
+    """The index (index.json) of a cache folder, locked against other
+    processes (e.g. the workers of batch_rv) while it is read, changed and
+    written back
+
+    :folder: The cache folder
+    :returns: The index as a dictionary, written when the block ends
+    """
+    findex = os.path.join(folder, 'index.json')
+    with open(os.path.join(folder, 'index.lock'), 'a') as lock:
+        try:
+            import fcntl
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        except ImportError:  # Windows: no lock
+            pass
+        try:
+            with open(findex) as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            index = {}
+        yield index
+        ftmp = '{0!s}.{1:d}.tmp'.format(findex, os.getpid())
+        with open(ftmp, 'w') as f:
+            json.dump(index, f)
+        os.rename(ftmp, findex)
+
+
+def _save(fname, x):
+    """np.save to a temporary file renamed into place, so other processes
+    never see a partly written file"""
+    ftmp = '{0!s}.{1:d}.tmp.npy'.format(fname, os.getpid())
+    np.save(ftmp, x)
+    os.rename(ftmp, fname)
+
+
+def template_bank(template, drvs, grid, cache_size=_BANK_SIZE):
+    """The template Doppler shifted to every RV of drvs and evaluated on grid,
+    as a (velocity x pixel) array
+
+    The bank is kept as a .npy file in ~/.plotfits/bank/ and returned memory
+    mapped, keyed by a hash of the template, the RV grid and the wavelength
+    grid, so it is only calculated once for many stars. When the banks take
+    more than cache_size the least recently used ones are removed.
+
+    :template: The wavelength and flux of the template (line depths)
+    :drvs: The RV grid in km/s
+    :grid: The wavelength grid
+    :cache_size: Size limit of the bank folder in MB
+    :returns: The shifted template (zero where it is not covered)
+    """
+    tw, tf = (np.ascontiguousarray(x, dtype=float) for x in template)
+    drvs, grid = np.asarray(drvs, dtype=float), np.asarray(grid, dtype=float)
+    key = hashlib.sha1()
+    for x in (tw, tf, drvs, grid):
+        key.update(x.tobytes())
+    key = key.hexdigest()
+
+    bank = os.path.join(_PATH, 'bank')
+    if not os.path.isdir(bank):
+        os.makedirs(bank)
+
+    fbank = os.path.join(bank, '{0!s}.npy'.format(key))
+
+    def add():
+        """Calculate the bank and rename it into place when complete"""
+        print('Adding template to the bank...')
+        ftmp = '{0!s}.{1:d}.tmp'.format(fbank, os.getpid())
+        T = np.lib.format.open_memmap(ftmp, mode='w+', dtype=np.float32,
+                                      shape=(len(drvs), len(grid)))
+        step = max(1, 2**22 // max(1, len(grid)))
+        for i in range(0, len(drvs), step):
+            T[i:i + step] = dopplerShiftBatch(tw, tf, drvs[i:i + step], edgeHandling='fillValue',
+                                              fill_value=0.0, wout=grid)[0]
+        T.flush()
+        del T
+        os.rename(ftmp, fbank)
+
+    # Calculated without the lock, so other processes do not wait for it
+    if not os.path.isfile(fbank):
+        add()
+
+    with _locked_index(bank) as index:
+        if not os.path.isfile(fbank):  # Removed by another process meanwhile
+            index.pop(key, None)
+            add()
+        # Banks missing from the index (e.g. from an interrupted run) are
+        # counted as well, so the size limit holds
+        for fname in os.listdir(bank):
+            old = fname[:-4]
+            if fname.endswith('.npy') and '.' not in old and old not in index:
+                fname = os.path.join(bank, fname)
+                index[old] = {'size': os.path.getsize(fname), 'used': os.path.getmtime(fname)}
+        index[key]['used'] = time.time()
+
+        # Remove the least recently used banks
+        total = sum(entry['size'] for entry in index.values())
+        for old in sorted(index, key=lambda k: index[k]['used']):
+            if total <= cache_size * 1024 ** 2 or old == key:
+                break
+            total -= index.pop(old)['size']
+            if os.path.isfile(os.path.join(bank, '{0!s}.npy'.format(old))):
+                os.remove(os.path.join(bank, '{0!s}.npy'.format(old)))
+
+        # Mapped while locked, so no other process removes it first
+        return np.load(fbank, mmap_mode='r')
+
+
+def ccf_bank(spectrum1, spectrum2, rvmin=0, rvmax=200, drv=1, full=False):
+    """Make a CCF between 2 spectra with a template bank (see template_bank)
+    and find the RV
+
+    The stellar spectrum is resampled once to a wavelength grid with its own
+    sampling (rounded) on the range of _template_range, so stars observed
+    with the same setup share the bank. The CCF is then one matrix-vector
+    product.
 
+    :spectrum1: The stellar spectrum
+    :spectrum2: The model, sun or telluric
+    :rvmin: The lowest RV
+    :rvmax: The highest RV
+    :drv: The velocity step
+    :full: Also return the fitted gaussian model
+    :returns: The RV shift
+    """
+    w, f = spectrum1
+    tw, tf = spectrum2
+    if not len(w) or not len(tw):
+        return (0, 0, 0, 0, 0, None) if full else (0, 0, 0, 0, 0)
+    dw = float('{0:.2g}'.format(np.median(np.diff(w))))
+    w0, w1 = _template_range(w, 'bank', pad=0)
+    grid = w0 + dw * np.arange(int(np.ceil((w1 - w0) / dw)) + 1)
+    drvs = np.arange(rvmin, rvmax, drv)
+    T = template_bank((tw, tf), drvs, grid)
+    cc = T.dot(np.interp(grid, w, f, left=0, right=0).astype(np.float32))
+    return _ccf_result(drvs, cc.astype(float), full=full)
+
+
+def read_linemask(fname):
+    """Read a line list as a mask for ccf_mask. Both the MOOG format from
+    numpy2moog and linelist_filter (a header line, and the wavelength in the
+    first column) and the VALD .dat from VALDprepare (comma separated, with
+    the wavelength in the 2nd column) are supported. The lines are weighted
+    by the central depth only for a VALD "extract stellar" list, where the
+    header kept by VALDprepare has a Depth column. Other lists, e.g. the
+    "extract all" from VALDextraction (the 10th column is the Lande factor),
+    get weight 1
+
+    :fname: The line list
+    :returns: The wavelength and weight of the lines
+    """
+    w, weight = [], []
+    idepth = None
+    with open(fname) as lines:
+        for line in lines:
+            if 'References' in line:
+                break
+            if line.startswith('#'):
+                # The column names of VALD, some of them with a space
+                names = line.lstrip('#').replace('Elm Ion', 'Elm_Ion').replace('log gf', 'log_gf').split()
+                if 'Depth' in names:
+                    idepth = names.index('Depth')
+                continue
+            vald = ',' in line
+            fields = [f.strip() for f in line.split(',')] if vald else line.split()
+            try:
+                wi = float(fields[1] if vald else fields[0])
+            except (ValueError, IndexError):
+                continue  # The header
+            try:
+                depth = float(fields[idepth]) if vald and idepth is not None else 1.0
+            except (ValueError, IndexError):
+                depth = 1.0
+            w.append(wi)
+            weight.append(depth)
+    i = np.argsort(w)
+    return np.array(w)[i], np.array(weight)[i]
+
+
+def ccf_mask(spectrum, mask, rvmin=0, rvmax=200, drv=1, width=3.0, full=False):
+    """Make a CCF between a spectrum and a (weighted) line mask
+
+    For each RV the flux of the spectrum is integrated inside a window around
+    each shifted line, from the cumulative integral of the spectrum at the
+    window edges (found with searchsorted). The cost scales with the number of
+    lines, not the number of pixels of a template.
+
+    :spectrum: The stellar spectrum (line depths, i.e. 1 - flux)
+    :mask: The wavelength and weight of the lines (see read_linemask)
+    :rvmin: The lowest RV
+    :rvmax: The highest RV
+    :drv: The velocity step
+    :width: The width of the window around each line in km/s
+    :full: Also return the fitted gaussian model
+    :returns: The output of ccf_astro
+    """
+    w, f = (np.asarray(x, dtype=float) for x in spectrum)
+    lw, weight = (np.asarray(x, dtype=float) for x in mask)
+    drvs = np.arange(rvmin, rvmax, drv)
+    c = 299792.458
+    half = lw * width / (2 * c)
+    inside = (lw * (1 + rvmin / c) - half > w[0]) & (lw * (1 + drvs[-1] / c) + half < w[-1]) if len(w) else []
+    if not np.any(inside):
+        print('Warning: No lines of the mask in the wavelength range')
+        return (0, 0, 0, 0, 0, None) if full else (0, 0, 0, 0, 0)
+    lw, weight, half = lw[inside], weight[inside], half[inside]
+
+    # Cumulative integral (trapezoid) of the spectrum at each pixel
+    F = np.concatenate(([0], np.cumsum(0.5 * (f[1:] + f[:-1]) * np.diff(w))))
+
+    def integral(x):
+        i = np.clip(np.searchsorted(w, x), 1, len(w) - 1)
+        x0, f0 = w[i - 1], f[i - 1]
+        fx = f0 + (f[i] - f0) * (x - x0) / (w[i] - x0)
+        return F[i - 1] + 0.5 * (f0 + fx) * (x - x0)
+
+    center = lw[np.newaxis, :] * (1 + drvs[:, np.newaxis] / c)
+    flux = integral(center + half) - integral(center - half)
+    cc = flux.dot(weight)
+    return _ccf_result(drvs, cc, full=full)
+
+
+def ccf_templates(spectrum, templates, method='direct', rvmin=0, rvmax=200,
+                  drv=1, full=False):
+    """Make the CCF between a spectrum and several templates
+
+    :spectrum: The stellar spectrum
+    :templates: A dictionary of templates, e.g. sun, model, telluric. A line
+    mask (key 'mask') always uses ccf_mask
+    :method: Method for the CCF (direct, fft, adaptive, bank)
+    :rvmin: The lowest RV
+    :rvmax: The highest RV
+    :drv: The velocity step
+    :full: Also return the fitted gaussian model for each template
+    :returns: A dictionary with the output of ccf_astro for each template
+    """
+    templates = dict(templates)
+    results = {}
+    if 'mask' in templates:
+        results['mask'] = ccf_mask(spectrum, templates.pop('mask'), rvmin, rvmax, drv, full=full)
+    if method == 'direct':
+        results.update(ccf_multi(spectrum, templates, rvmin, rvmax, drv, full=full))
+        return results
+    ccf_func = {'fft': ccf_fft, 'adaptive': ccf_adaptive, 'bank': ccf_bank}[method]
+    results.update({key: ccf_func(spectrum, templates[key], rvmin, rvmax, drv, full=full)
+                    for key in templates})
+    return results
+
+
+def _ccf_result(drvs, cc, full=False):
+    """Normalize the CCF and fit it with a gaussian
+
+    :drvs: The RV grid
+    :cc: The CCF
+    :full: Also return the fitted gaussian model
+    :returns: The RV, RV grid, normalized CCF, and the gaussian fit
+    """
     if not np.any(cc):
-        return 0, 0, 0, 0, 0
+        return (0, 0, 0, 0, 0, None) if full else (0, 0, 0, 0, 0)
 
     # Fit the CCF with a gaussian
     cc[cc == 0] = np.mean(cc)
     cc = (cc-min(cc))/(max(cc)-min(cc))
     RV, g = _fit_ccf(drvs, cc)
+    if full:
+        return int(RV), drvs, cc, drvs, g(drvs), g
     return int(RV), drvs, cc, drvs, g(drvs)
 
 
-def _fit_ccf(rv, ccf):
+class Gaussian:
+    """A 1D gaussian with the parameters of astropy's Gaussian1D, without
+    importing astropy.modeling"""
+
+    def __init__(self, amplitude, mean, stddev):
+        self.amplitude = amplitude
+        self.mean = mean
+        self.stddev = stddev
+
+    def __call__(self, x):
+        return self.amplitude * np.exp(-0.5 * ((x - self.mean) / self.stddev) ** 2)
+
+
+def fit_peaks(rv, ccf, npoints=5):
+    """Fit a gaussian to the peak of one or many CCFs at once
+
+    A parabola is fitted to the logarithm of the npoints around the maximum
+    (weighted by the CCF squared), which gives the gaussian analytically. If
+    several points tie at the maximum the middle one is used.
+
+    :rv: The RV grid (the same for all CCFs)
+    :ccf: The CCF values (1D, or one row for each CCF)
+    :npoints: The number of points around the maximum to fit
+    :returns: The amplitude, RV and width of the gaussian for each CCF (NaN
+    width, and the RV of the middle of the highest points, if the peak is not
+    a maximum, is at the edge of the RV grid, or the fitted RV is outside the
+    fitted points). A CCF with NaN (e.g. from NaN pixels in the spectrum) is
+    not fitted, and has NaN width and RV
+    """
+    rv = np.asarray(rv, dtype=float)
+    ccf = np.atleast_2d(np.asarray(ccf, dtype=float))
+    finite = np.all(np.isfinite(ccf), axis=-1)
+    ccf = np.where(finite[:, np.newaxis], ccf, 0)
+    n = ccf.shape[-1]
+    npoints = min(npoints, n)
+    # The middle of the highest points if several tie at the maximum
+    peak = (np.argmax(ccf, axis=-1) + n - 1 - np.argmax(ccf[:, ::-1], axis=-1)) // 2
+    start = np.clip(peak - npoints // 2, 0, n - npoints)
+    idx = start[:, np.newaxis] + np.arange(npoints)
+    x = rv[idx] - rv[peak][:, np.newaxis]
+    y = np.take_along_axis(ccf, idx, axis=-1)
+    weight = np.clip(y, 0, None) ** 2
+    logy = np.log(np.clip(y, 1e-10, None))
+
+    # Weighted least squares for log(y) = a + b*x + c*x**2 for all CCFs
+    X = np.stack((np.ones_like(x), x, x ** 2), axis=-1)
+    A = np.einsum('mki,mk,mkj->mij', X, weight, X)
+    B = np.einsum('mki,mk,mk->mi', X, weight, logy)
+    a, b, c = np.einsum('mij,mj->mi', np.linalg.pinv(A), B).T
+
+    top = ccf == ccf.max(axis=-1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shift = -b / (2 * c)
+        # A peak at the edge would be extrapolated outside the RV grid
+        ok = finite & (c < 0) & (peak > 0) & (peak < n - 1) & \
+            (shift >= x[:, 0]) & (shift <= x[:, -1])
+        mean = np.where(ok, rv[peak] + shift, np.sum(top * rv, axis=-1) / np.sum(top, axis=-1))
+        mean = np.where(finite, mean, np.nan)
+        stddev = np.where(ok, np.sqrt(-1 / (2 * c)), np.nan)
+        amplitude = np.where(ok, np.exp(a - b ** 2 / (4 * c)), ccf[np.arange(len(ccf)), peak])
+    return amplitude, mean, stddev
+
+
+def _fit_ccf(rv, ccf, refine=None):
     """Fit the CCF with a 1D gaussian
     :rv: The RV vector
     :ccf: The CCF values
-    :returns: The RV, and best fit gaussian
+    :refine: Refine the fit with astropy's LevMarLSQFitter on the 20 points
+    around the maximum (default: _REFINE_FIT)
+    :returns: The RV (0 if no gaussian could be fitted), and best fit
+    gaussian (with a NaN width if no gaussian could be fitted)
 
     """
-    ampl = 1
-    mean = rv[ccf == ampl]
-    I = np.where(ccf == ampl)[0]
-
-    g_init = models.Gaussian1D(amplitude=ampl, mean=mean, stddev=5)
-    fit_g = fitting.LevMarLSQFitter()
-
-    try:
-        g = fit_g(g_init, rv[I - 10:I + 10], ccf[I - 10:I + 10])
-    except TypeError:
+    amplitude, mean, stddev = (p[0] for p in fit_peaks(rv, ccf))
+    if not np.isfinite(stddev):
+        print('Warning: Not able to fit a gaussian to the CCF')
+        return 0, Gaussian(amplitude, mean, np.nan)
+    g = Gaussian(amplitude, mean, stddev)
+    if refine is None:
+        refine = _REFINE_FIT
+    if not refine:
+        return mean, g
+
+    from astropy.modeling import models, fitting
+    I = int(np.argmax(ccf))
+    s = slice(max(I - 10, 0), I + 10)
+    g_init = models.Gaussian1D(amplitude=amplitude, mean=mean, stddev=stddev)
+    g = fitting.LevMarLSQFitter()(g_init, rv[s], ccf[s])
+    if not rv[0] <= g.mean.value <= rv[-1]:
         print('Warning: Not able to fit a gaussian to the CCF')
-        return 0, g_init
-    RV = g.mean.value
-    return RV, g
+        return 0, Gaussian(amplitude, mean, np.nan)
+    return g.mean.value, g
 
 
 def nrefrac(wavelength, density=1.0):
@@ -194,37 +919,72 @@ def dopplerShift(wvl, flux, v, edgeHandling='firstlast', fill_value=None):
     # Shifted wavelength axis
     wlprime = wvl * (1.0 + v / 299792.458)
 
-    f = sci.interp1d(wlprime, flux, bounds_error=False, fill_value=np.nan)
-    nflux = f(wlprime)
+    # The shifted flux at the old wavelengths, with the edges filled from the
+    # first/last valid point of the batched version
+    nflux = dopplerShiftBatch(wvl, flux, [v], edgeHandling=edgeHandling,
+                              fill_value=fill_value)[0][0]
+    return nflux, wlprime
 
-    if edgeHandling == "firstlast":
-        firsts = []
-        # Search for first non-NaN value save indices of
-        # leading NaN values
-        for i, nfluxi in enumerate(nflux):
-            if np.isnan(nfluxi):
-                firsts.append(i)
-            else:
-                firstval = nfluxi
-                break
 
-        # Do the same for trailing NaNs
-        lasts = []
-        for i, nfluxi in enumerate(nflux[::-1]):
-            if np.isnan(nfluxi):
-                lasts.append(i)
-            else:
-                lastval = nfluxi
-                break
+def dopplerShiftBatch(wvl, flux, v, edgeHandling='firstlast', fill_value=None,
+                      wout=None):
+    """Doppler shift a spectrum by many velocities at once.
+
+    The batched version of dopplerShift. The shifted flux is obtained at the
+    old, unshifted wavelength points (or at wout) for every velocity in one
+    vectorized interpolation, and the edges are filled from the first/last
+    valid index of each row.
+
+    Parameters
+    ----------
+    wvl : array
+        Input wavelengths in A (increasing).
+    flux : array
+        Input flux.
+    v : array
+        Doppler shifts in km/s
+    edgeHandling : string, {"fillValue", "firstlast"}, optional
+        The method used to handle the edges of the
+        output spectrum.
+    fill_value : float, optional
+        If given, the value used to fill the edges of the output spectrum.
+    wout : array, optional
+        The wavelengths where the shifted flux is obtained (increasing).
+        Default is the old input wavelengths, as in dopplerShift.
+
+    Returns
+    -------
+    nflux : array
+        The shifted flux arrays at the *old* input locations, or at wout
+        (n_v x n_pix).
+    wlprime : array
+        The shifted wavelength axes (n_v x len(wvl)).
+    """
+    wvl = np.asarray(wvl, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    wout = wvl if wout is None else np.asarray(wout, dtype=float)
+    scale = 1.0 + np.atleast_1d(np.asarray(v, dtype=float)) / 299792.458
 
-        # Use first and last non-NaN value to
-        # fill the nflux array
+    # Shifted wavelength axis and the shifted flux at the old wavelengths
+    wlprime = wvl[np.newaxis, :] * scale[:, np.newaxis]
+    nflux = _interp_batch(wout[np.newaxis, :] / scale[:, np.newaxis], wvl, flux)
+
+    valid = ~np.isnan(nflux)
+    if edgeHandling == "firstlast":
+        # First and last non-NaN value of each row
+        rows = np.arange(len(scale))
+        first = np.argmax(valid, axis=1)
+        last = nflux.shape[1] - 1 - np.argmax(valid[:, ::-1], axis=1)
+        idx = np.arange(nflux.shape[1])
+        leading = idx < first[:, np.newaxis]
+        trailing = idx > last[:, np.newaxis]
         if fill_value:
-            nflux[firsts] = fill_value
-            nflux[lasts] = fill_value
+            nflux[leading | trailing] = fill_value
         else:
-            nflux[firsts] = firstval
-            nflux[lasts] = lastval
+            nflux = np.where(leading, nflux[rows, first][:, np.newaxis], nflux)
+            nflux = np.where(trailing, nflux[rows, last][:, np.newaxis], nflux)
+    elif edgeHandling == "fillValue":
+        nflux[~valid] = fill_value
     return nflux, wlprime
 
 
@@ -242,23 +1002,661 @@ def get_wavelength(hdr):
     return np.linspace(w0, w1, n, endpoint=False)
 
 
-@Gooey(program_name='Plot fits - Easy 1D fits plotting', default_size=(610, 730))
-def _parser():
+def get_references(sun=False, telluric=False, model=False):
+    """Make sure the reference spectra are available in ~/.plotfits/ and
+    download the missing ones.
+
+    :sun: Solar spectrum is needed
+    :telluric: Telluric spectrum is needed
+    :model: Wavelength vector for PHOENIX models is needed
+    :returns: Dictionary with the paths to the sun, telluric, wave and GIANO
+    files
+    """
+    path = _PATH
+    paths = {'sun': os.path.join(path, 'solarspectrum_01.fits'),
+             'telluric': os.path.join(path, 'telluric_NIR.fits'),
+             'wave': os.path.join(path, 'WAVE_PHOENIX-ACES-AGSS-COND-2011.fits'),
+             'GIANO': os.path.join(path, 'wavelength_GIANO.dat')}
+    if os.path.isdir(path):
+        if sun and (not os.path.isfile(paths['sun'])):
+            print('Downloading solar spectrum...')
+            _download_spec(paths['sun'])
+        if telluric and (not os.path.isfile(paths['telluric'])):
+            print('Downloading telluric spectrum...')
+            _download_spec(paths['telluric'])
+        if model and (not os.path.isfile(paths['wave'])):
+            print('Downloading wavelength vector for model...')
+            url = 'ftp://phoenix.astro.physik.uni-goettingen.de/HiResFITS//WAVE_PHOENIX-ACES-AGSS-COND-2011.fits'
+            urllib.urlretrieve(url, paths['wave'])
+    else:
+        os.mkdir(path)
+        print('{0!s} Created'.format(path))
+        print('Downloading solar spectrum...')
+        _download_spec(paths['sun'])
+        print('Downloading telluric spectrum...')
+        _download_spec(paths['telluric'])
+    return paths
+
+
+def _pixels(crval, cdelt, n, w0=None, w1=None):
+    """The pixels of an equidistant wavelength grid inside w0..w1 (with one
+    extra pixel on each side for rounding)
+
+    :crval: The first wavelength
+    :cdelt: The wavelength step
+    :n: The number of pixels
+    :w0: The first wavelength (None for the start of the grid)
+    :w1: The last wavelength (None for the end of the grid)
+    :returns: The first and last (exclusive) pixel
+    """
+    p0 = 0 if w0 is None else int(min(n, max(0, np.floor((w0 - crval) / cdelt))))
+    p1 = n if w1 is None else int(min(n, max(0, np.ceil((w1 - crval) / cdelt) + 1)))
+    return p0, max(p0, p1)
+
+
+def read_spectrum(fname, ftype='1D', fitsext=0, order=77, w0=None, w1=None):
+    """Read the wavelength and flux of a spectrum
+
+    The file is opened once and memory mapped. With w0 and/or w1 only the
+    pixels inside w0..w1 (from the wavelength in the header) are read.
+
+    :fname: Input spectrum. A single spectrum of a file made with
+    ascii2fits.convert2container is given as "container.fits[name]"
+    :ftype: Type of fits file (1D, CRIRES, GIANO)
+    :fitsext: Fits extention to use
+    :order: GIANO order ('merged' merges all orders to one spectrum)
+    :w0: The first wavelength to read
+    :w1: The last wavelength to read
+    :returns: The wavelength and flux
+    """
+    from astropy.io import fits
+    fitsext = int(fitsext)
+    if fname.endswith(']') and not os.path.isfile(fname):
+        from ascii2fits import read_container
+        fname, _, name = fname[:-1].rpartition('[')
+        return read_container(fname, name)
+    if ftype == 'GIANO' and str(order) == 'merged':
+        _, w, I = read_giano_orders(fname)
+        w, I = merge_orders(w, I)
+        good = np.isfinite(I)  # Drop the gaps between the orders
+        if w0 is not None:
+            good &= w >= w0
+        if w1 is not None:
+            good &= w <= w1
+        return w[good], I[good]
+    order = int(order)
+
+    with fits.open(fname, memmap=True) as hdulist:
+        if ftype == '1D':
+            hdu = hdulist[fitsext]
+            crval, cdelt, n = hdu.header['CRVAL1'], hdu.header['CDELT1'], hdu.header['NAXIS1']
+            p0, p1 = _pixels(crval, cdelt, n, w0, w1)
+            I = np.array(hdu.section[p0:p1])
+            w = get_wavelength(hdu.header)[p0:p1]
+        elif ftype == 'CRIRES':
+            d = hdulist[fitsext].data
+            names = d.columns.names
+            I = d['Extracted_OPT' if 'Extracted_OPT' in names else 'Extracted_DRACS']  # Gasgano or Dracs reduction
+            w = d['Wavelength']*10
+            p0 = 0 if w0 is None else np.searchsorted(w, w0)
+            p1 = len(w) if w1 is None else np.searchsorted(w, w1, side='right')
+            w, I = np.array(w[p0:p1]), np.array(I[p0:p1])
+        elif ftype == 'GIANO':
+            hdu = hdulist[0]
+            n = hdu.header['NAXIS1']
+            wa, wb = _giano_wavelengths()[order]
+            p0, p1 = _pixels(wa, (wb - wa) / (n - 1), n, w0, w1)
+            I = np.array(hdu.section[order - 32, p0:p1])  # 32 is the first order
+            w = np.linspace(wa, wb, n)[p0:p1]
+    return w, I
+
+
+def _giano_wavelengths():
+    """The first and last wavelength of each GIANO order. The table is read
+    once per process (and kept as .npy next to the ASCII table)
+
+    :returns: Dictionary with the (first, last) wavelength of each order
+    """
+    if not _GIANO_WAVELENGTHS:
+        fname = os.path.join(_PATH, 'wavelength_GIANO.dat')
+        fnpy = fname.rpartition('.')[0] + '.npy'
+        if os.path.isfile(fnpy) and os.path.getmtime(fnpy) >= os.path.getmtime(fname):
+            wd = np.load(fnpy)
+        else:
+            wd = np.loadtxt(fname)
+            np.save(fnpy, wd)
+        for order, w1, w2 in wd[:, :3]:
+            _GIANO_WAVELENGTHS[int(order)] = (w1, w2)
+    return _GIANO_WAVELENGTHS
+
+
+def read_giano_orders(fname):
+    """Read all orders of a GIANO spectrum with a single read of the file
+
+    :fname: Input spectrum
+    :returns: The order numbers, and the wavelength and flux (n_orders x
+    n_pixels)
+    """
+    from astropy.io import fits
+    I = fits.getdata(fname)
+    orders = np.arange(32, 32 + len(I))  # 32 is the first order
+    table = _giano_wavelengths()
+    w1, w2 = np.array([table[order] for order in orders]).T
+    w = w1[:, np.newaxis] + (w2 - w1)[:, np.newaxis] * np.linspace(0, 1, I.shape[1])
+    return orders, w, I
+
+
+def merge_orders(w, I, dw=None):
+    """Merge the orders of an echelle spectrum to a single 1D spectrum on an
+    equidistant wavelength grid. Overlapping orders are blended with weights
+    that go linearly down to half a pixel at the edges of each order (and to
+    zero half a pixel outside it), so the first and last pixel of an order
+    still count.
+
+    :w: The wavelength of each order (n_orders x n_pixels)
+    :I: The flux of each order (n_orders x n_pixels)
+    :dw: The wavelength step of the output (default: the smallest median step
+    of the orders)
+    :returns: The merged wavelength and flux
+    """
+    w, I = np.atleast_2d(w).astype(float), np.atleast_2d(I).astype(float)
+    flip = w[:, 0] > w[:, -1]
+    w[flip], I[flip] = w[flip, ::-1], I[flip, ::-1]
+    if dw is None:
+        dw = np.min(np.median(np.diff(w, axis=1), axis=1))
+    wmin, wmax = w[:, 0].min(), w[:, -1].max()
+    wout = wmin + dw * np.arange(int((wmax - wmin) / dw) + 1)
+
+    # Offset every order so all orders are one sorted array, and find the
+    # pixel to the left of each output wavelength in every order at once
+    n_orders, n_pixels = w.shape
+    offset = (np.arange(n_orders) * (wmax - wmin + 1))[:, np.newaxis]
+    idx = np.searchsorted((w + offset).ravel(), (wout + offset).ravel())
+    idx = idx.reshape(n_orders, -1) - np.arange(n_orders)[:, np.newaxis] * n_pixels
+    idx = np.clip(idx, 1, n_pixels - 1)
+    rows = np.arange(n_orders)[:, np.newaxis]
+    x0, x1 = w[rows, idx - 1], w[rows, idx]
+    y0, y1 = I[rows, idx - 1], I[rows, idx]
+    flux = y0 + (y1 - y0) * (wout - x0) / (x1 - x0)
+
+    step = np.median(np.diff(w, axis=1), axis=1)[:, np.newaxis]
+    weight = np.minimum(wout - w[:, :1], w[:, -1:] - wout) + 0.5 * step
+    weight = np.where(np.isfinite(flux), np.clip(weight, 0, None), 0)
+    norm = weight.sum(axis=0)
+    Iout = np.sum(np.where(weight > 0, flux * weight, 0), axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        Iout = np.where(norm > 0, Iout / norm, np.nan)
+    return wout, Iout
+
+
+def write_spectrum(fname, w, I, clobber=True):
+    """Write a spectrum on an equidistant wavelength grid as a 1D fits file
+    (CRVAL1/CDELT1), which can be read by get_wavelength and ARES
+
+    :fname: Output fits file
+    :w: The equidistant wavelength
+    :I: The flux
+    :clobber: Overwrite existing files
+    """
+    from astropy.io import fits
+    hdr = fits.Header()
+    hdr['CRVAL1'] = w[0]
+    hdr['CDELT1'] = (w[-1] - w[0]) / (len(w) - 1)
+    fits.writeto(fname, np.asarray(I), header=hdr, overwrite=clobber)
+
+
+def build_reference_store(fname, tile=65536):
+    """Convert a 1D reference spectrum (e.g. the solar or telluric spectrum)
+    to a wavelength-tiled store with a small index. The store is a folder
+    next to the fits file with one .npy file per tile.
+
+    :fname: The 1D fits file ('CRVAL1', 'CDELT1', and 'NAXIS1' is required)
+    :tile: Number of pixels in each tile
+    :returns: The index of the store
+    """
+    from astropy.io import fits
+    store = fname.rpartition('.')[0]
+    if not os.path.isdir(store):
+        os.mkdir(store)
+    with fits.open(fname, memmap=True) as hdulist:
+        I = np.array(hdulist[0].data)
+        hdr = hdulist[0].header
+    w0, dw, n = hdr['CRVAL1'], hdr['CDELT1'], hdr['NAXIS1']
+    ntiles = int(np.ceil(n / tile))
+    for i in range(ntiles):
+        np.save(os.path.join(store, 'tile_{0:05d}.npy'.format(i)),
+                I[i * tile:(i + 1) * tile])
+    index = {'CRVAL1': w0, 'CDELT1': dw, 'NAXIS1': n, 'tile': tile,
+             'starts': [w0 + dw * i * tile for i in range(ntiles)],
+             'source': [os.path.getsize(fname), os.path.getmtime(fname)]}
+    with open(os.path.join(store, 'index.json'), 'w') as f:
+        json.dump(index, f)
+    return index
+
+
+def read_reference(fname, w0, w1):
+    """Read the part of a 1D reference spectrum between w0 and w1 from its
+    tiled store. The store is built the first time (or if the fits file has
+    changed), and afterwards only the tiles covering w0..w1 are read.
+
+    :fname: The 1D fits file of the reference spectrum
+    :w0: The first wavelength
+    :w1: The last wavelength
+    :returns: The wavelength and flux between w0 and w1
+    """
+    store = fname.rpartition('.')[0]
+    try:
+        with open(os.path.join(store, 'index.json')) as f:
+            index = json.load(f)
+        if index['source'] != [os.path.getsize(fname), os.path.getmtime(fname)]:
+            raise ValueError('Store is outdated')
+    except (IOError, ValueError, KeyError):
+        print('Creating tiled store of {0!s}...'.format(fname))
+        index = build_reference_store(fname)
+
+    crval, cdelt, n, tile = index['CRVAL1'], index['CDELT1'], index['NAXIS1'], index['tile']
+    p0, p1 = _pixels(crval, cdelt, n, w0, w1)
+    if p1 <= p0:
+        return np.array([]), np.array([])
+    t0 = np.searchsorted(index['starts'], crval + p0 * cdelt, side='right') - 1
+    t1 = np.searchsorted(index['starts'], crval + (p1 - 1) * cdelt, side='right') - 1
+    tiles = [np.load(os.path.join(store, 'tile_{0:05d}.npy'.format(i)), mmap_mode='r')
+             for i in range(max(t0, 0), t1 + 1)]
+    offset = max(t0, 0) * tile
+    I = np.concatenate(tiles)[p0 - offset:p1 - offset]
+    w = crval + cdelt * np.arange(p0, p1)
+    i = (w > w0) & (w < w1)
+    return w[i], np.array(I[i])
+
+
+def _air_wavelength(w):
+    """Convert vacuum wavelengths to air (ground based)"""
+    nre = nrefrac(w)  # Correction for vacuum to air (ground based)
+    return w / (1 + 1e-6 * nre)
+
+
+def read_model(model, pathwave, cache_size=_MODEL_CACHE_SIZE):
+    """Read a model spectrum with the wavelength in air
+
+    The flux and the air wavelength are kept as .npy files in the model cache
+    (~/.plotfits/models/) and returned memory-mapped, so each model is only
+    read from the fits file and converted once. The air wavelength of the
+    PHOENIX grid is shared by all models. When the cache is larger than
+    cache_size the least recently used models are removed.
+
+    :model: The model spectrum (BT-Settl or PHOENIX)
+    :pathwave: The PHOENIX wavelength vector
+    :cache_size: Size limit of the model cache in MB (0 disables the cache)
+    :returns: The air wavelength and flux
+    """
+    from astropy.io import fits
+    if not cache_size:
+        with fits.open(model, memmap=True) as hdulist:
+            I_mod, hdr = hdulist[0].data, hdulist[0].header
+        if 'WAVE' in hdr.keys():
+            w_mod = fits.getdata(pathwave)
+        else:
+            w_mod = get_wavelength(hdr)
+        return _air_wavelength(w_mod), I_mod
+
+    cache = os.path.join(_PATH, 'models')
+    if not os.path.isdir(cache):
+        os.makedirs(cache)
+
+    model = os.path.abspath(model)
+    key = '{0!s}-{1!s}-{2!s}'.format(model, os.path.getsize(model), os.path.getmtime(model))
+    key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    fflux = os.path.join(cache, '{0!s}.npy'.format(key))
+
+    def add():
+        """Convert the model and rename each file into place when complete"""
+        print('Adding model to the cache...')
+        with fits.open(model, memmap=True) as hdulist:
+            I_mod, hdr = hdulist[0].data, hdulist[0].header
+        if 'WAVE' in hdr.keys():
+            fwave = 'WAVE_air.npy'
+            if not os.path.isfile(os.path.join(cache, fwave)):
+                _save(os.path.join(cache, fwave), _air_wavelength(fits.getdata(pathwave)))
+            size = I_mod.nbytes
+        else:
+            fwave = '{0!s}_wave.npy'.format(key)
+            w_mod = _air_wavelength(get_wavelength(hdr))
+            _save(os.path.join(cache, fwave), w_mod)
+            size = I_mod.nbytes + w_mod.nbytes
+        _save(fflux, I_mod)
+        return {'model': model, 'wave': fwave, 'size': size}
+
+    # Converted without the lock, so the workers of batch_rv do not wait for
+    # each other
+    entry = None if os.path.isfile(fflux) else add()
+
+    with _locked_index(cache) as index:
+        if key in index:
+            entry = index[key]
+        elif entry is None:  # In the cache, but not in the index
+            fwave = '{0!s}_wave.npy'.format(key)
+            if not os.path.isfile(os.path.join(cache, fwave)):
+                fwave = 'WAVE_air.npy'
+            entry = {'model': model, 'wave': fwave, 'size': None}
+        if not (os.path.isfile(fflux) and os.path.isfile(os.path.join(cache, entry['wave']))):
+            entry = add()  # Removed by another process meanwhile
+        if entry['size'] is None:
+            entry['size'] = os.path.getsize(fflux)
+        index[key] = entry
+        entry['used'] = time.time()
+
+        # Remove the least recently used models
+        total = sum(e['size'] for e in index.values())
+        for old in sorted(index, key=lambda k: index[k]['used']):
+            if total <= cache_size * 1024 ** 2 or old == key:
+                break
+            e = index.pop(old)
+            total -= e['size']
+            for fout in ('{0!s}.npy'.format(old), e['wave']):
+                if fout != 'WAVE_air.npy' and os.path.isfile(os.path.join(cache, fout)):
+                    os.remove(os.path.join(cache, fout))
+
+        # Mapped while locked, so no other process removes the files first
+        w_mod = np.load(os.path.join(cache, index[key]['wave']), mmap_mode='r')
+        return w_mod, np.load(fflux, mmap_mode='r')
+
+
+def _norm_median(w, I):
+    """Normalize by the median"""
+    return I / np.median(I, axis=-1, keepdims=True)
+
+
+def _norm_top50(w, I):
+    """Normalize by the median and then by a constant continuum: the median
+    of the 50 highest points below 1.2"""
+    I = _norm_median(w, I)
+    top = np.where(I < 1.2, I, -np.inf)
+    k = min(50, top.shape[-1])
+    # Partial sort (linear time) instead of a full argsort
+    top = np.partition(top, -k, axis=-1)[..., -k:]
+    top[np.isinf(top)] = np.nan
+    return I / np.nanmedian(top, axis=-1, keepdims=True)
+
+
+def _norm_continuum(w, I, chunk=100, percentile=95):
+    """Normalize by a continuum that follows a sloped or curved spectrum: a
+    spline through the upper percentile of chunks of the spectrum"""
+    n = I.shape[-1]
+    nchunks = int(np.ceil(n / chunk))
+    pad = [(0, 0)] * (I.ndim - 1) + [(0, nchunks * chunk - n)]
+    chunks = np.pad(I, pad, mode='edge').reshape(I.shape[:-1] + (nchunks, chunk))
+    level = np.percentile(chunks, percentile, axis=-1)  # linear time
+
+    # The spline is in pixels, so spectra in a batch can have different
+    # wavelengths (e.g. echelle orders)
+    if nchunks == 1:
+        return I / level
+    from scipy.interpolate import make_interp_spline
+    x = np.minimum((np.arange(nchunks) + 0.5) * chunk, n - 1)
+    continuum = make_interp_spline(x, level, k=min(3, nchunks - 1), axis=-1)(np.arange(n))
+    return I / continuum
+
+
+_NORMALIZATIONS = {'top50': _norm_top50,
+                   'continuum': _norm_continuum,
+                   'median': _norm_median}
+
+
+def normalize(w, I, method='top50', **kwargs):
+    """Normalize one spectrum or a batch of spectra
+
+    :w: The wavelength (1D, or one row for each spectrum)
+    :I: The flux (1D, or a 2D array with one row for each spectrum)
+    :method: The normalization: 'top50' (the median of the 50 highest points
+    below 1.2 as a constant continuum), 'continuum' (a spline through the
+    upper percentile of chunks of the spectrum), 'median', or a function
+    f(w, I) doing the normalization
+    :kwargs: Keywords for the method (e.g. chunk and percentile for continuum)
+    :returns: The normalized flux
+    """
+    I = np.asarray(I, dtype=float)
+    norm = method if callable(method) else _NORMALIZATIONS[method]
+    return norm(w, I, **kwargs)
+
+
+def _window(spectrum, w0, w1, continuum=False):
+    """Cut out a part of a (reference) spectrum and normalize it
+
+    :spectrum: The wavelength and flux
+    :w0: The first wavelength
+    :w1: The last wavelength
+    :continuum: Normalize by the continuum as well (otherwise only median)
+    :returns: The wavelength and flux between w0 and w1
+    """
+    w, I = spectrum
+    # Binary search on the (increasing) wavelength instead of a full mask
+    i0, i1 = np.searchsorted(w, w0, side='right'), np.searchsorted(w, w1, side='left')
+    w = np.array(w[i0:i1])
+    I = np.array(I[i0:i1])
+    if len(w) > 0:
+        if continuum:
+            # https://phoenix.ens-lyon.fr/Grids/FORMAT
+            # I = 10 ** (I-8.0)
+            I = normalize(w, I)
+        else:
+            I = I / np.median(I)
+    return w, I
+
+
+def _template_range(w, ccf_method='direct', pad=10):
+    """The wavelength range of the templates for the CCF of a spectrum. For
+    the template bank the range is rounded outwards to _BANK_ROUND, so the
+    templates (and the bank) of stars observed with the same setup are the
+    same, even if their coverage differs by a few pixels.
+
+    :w: The wavelength of the spectrum
+    :ccf_method: Method for the CCF (direct, fft, adaptive, bank)
+    :pad: Some extra coverage for RV shifts
+    :returns: The first and last wavelength
+    """
+    w0, w1 = w[0] - pad, w[-1] + pad
+    if ccf_method == 'bank':
+        w0 = np.floor(w0 / _BANK_ROUND) * _BANK_ROUND
+        w1 = np.ceil(w1 / _BANK_ROUND) * _BANK_ROUND
+    return w0, w1
+
+
+def _templates(w, I, references, ccf='both', ccf_method='direct'):
+    """Cut out and normalize the templates needed for the CCF of a spectrum
+
+    :w: The wavelength of the (normalized) spectrum
+    :I: The flux of the (normalized) spectrum
+    :references: Dictionary with full sun, model, and/or telluric spectra,
+    and/or a line mask
+    :ccf: Calculate CCF for (sun, model, telluric, both, mask)
+    :ccf_method: Method for the CCF (see _template_range)
+    :returns: Dictionary with the templates as line depths (1 - flux), and/or
+    the line mask
+    """
+    w0, w1 = _template_range(w, ccf_method)
+    spectra = {}
+    for key in ('sun', 'model', 'telluric'):
+        if key in references:
+            spectra[key] = _window(references[key], w0, w1, continuum=key == 'model')
+    if 'model' in spectra:
+        spectra.pop('sun', None)
+
+    templates = {}
+    if ccf in ['sun', 'both'] and 'sun' in spectra:
+        w_sun, I_sun = spectra['sun']
+        if 'telluric' in spectra and len(w_sun) == len(spectra['telluric'][0]):
+            I_sun = I_sun / spectra['telluric'][1]
+        templates['sun'] = (w_sun, -I_sun + 1)
+    if ccf in ['model', 'both'] and 'model' in spectra:
+        templates['model'] = (spectra['model'][0], -spectra['model'][1] + 1)
+    if ccf in ['telluric', 'both'] and 'telluric' in spectra:
+        templates['telluric'] = (spectra['telluric'][0], -spectra['telluric'][1] + 1)
+    if ccf == 'mask' and 'mask' in references:
+        templates['mask'] = references['mask']
+    return templates
+
+
+def load_references(sun=False, telluric=False, model=False,
+                    model_cache=_MODEL_CACHE_SIZE, linelist=False):
+    """Load the full reference spectra, e.g. once for many CCFs
+
+    :sun: Load the solar spectrum
+    :telluric: Load the telluric spectrum
+    :model: Load this model spectrum
+    :model_cache: Size limit of the model cache in MB (0 disables the cache)
+    :linelist: Load this line list as a mask (see read_linemask)
+    :returns: Dictionary with the sun, model, and/or telluric spectra, and/or
+    the line mask
+    """
+    paths = get_references(sun=sun, telluric=telluric, model=model)
+    references = {}
+    if linelist:
+        references['mask'] = read_linemask(linelist)
+    if sun:
+        references['sun'] = read_spectrum(paths['sun'])
+    if model:
+        references['model'] = read_model(model, paths['wave'], cache_size=model_cache)
+    if telluric:
+        references['telluric'] = read_spectrum(paths['telluric'])
+    return references
+
+
+def gaussian_parameters(g):
+    """The amplitude, center and width of the gaussian fitted to a CCF
+
+    :g: The fitted gaussian (None if no CCF)
+    :returns: The amplitude, center and width (NaN if no CCF)
+    """
+    if g is None:
+        return np.nan, np.nan, np.nan
+    return tuple(float(np.ravel(getattr(p, 'value', p))[0]) for p in (g.amplitude, g.mean, g.stddev))
+
+
+def rv_orders(w, I, references, ccf='telluric', ccf_method='direct',
+              rvmin=0, rvmax=200, drv=1, norm='top50'):
+    """Calculate the RV of every order of an echelle spectrum and combine them
+
+    All orders are normalized in one batch, and with the direct method the
+    CCFs of all orders are calculated in one batch as well (see ccf_orders).
+    Each order is weighted by 1/variance of its normalized CCF away from the
+    peak.
+
+    :w: The wavelength (n_orders x n_pixels)
+    :I: The flux (n_orders x n_pixels)
+    :references: Dictionary with full sun, model, and/or telluric spectra
+    :ccf: Calculate CCF for (sun, model, telluric, both)
+    :ccf_method: Method for the CCF (direct, fft, adaptive, bank)
+    :rvmin: The lowest RV
+    :rvmax: The highest RV
+    :drv: The velocity step
+    :norm: Normalization of the spectra (top50, continuum, median)
+    :returns: Dictionary with the RV and weight of each order, and the
+    weighted RV and its uncertainty, for each template
+    """
+    I = normalize(w, I, method=norm)
+    templates = [_templates(wi, Ii, references, ccf=ccf, ccf_method=ccf_method)
+                 for wi, Ii in zip(w, I)]
+    if ccf_method == 'direct':
+        results = ccf_orders(w, -I + 1, templates, rvmin, rvmax, drv, full=True)
+    else:
+        # The other methods have their own grid (and bank) for each order
+        results = [ccf_templates((wi, -Ii + 1), t, ccf_method, rvmin, rvmax,
+                                 drv, full=True)
+                   for wi, Ii, t in zip(w, I, templates)]
+    out = {}
+    for i in range(len(w)):
+        for key, (RV, r, c, _, _, g) in results[i].items():
+            rvs, weights = out.setdefault(key, (np.full(len(w), np.nan), np.zeros(len(w))))
+            # The RV is truncated to km/s, so the fit decides if it failed
+            _, center, sigma = gaussian_parameters(g)
+            if not np.isfinite(sigma):
+                continue
+            rvs[i] = center
+            noise = np.std(c[np.abs(r - rvs[i]) > 3 * abs(sigma)])
+            weights[i] = 1 / noise ** 2 if noise > 0 else 0
+
+    combined = {}
+    for key, (rvs, weights) in out.items():
+        good = np.isfinite(rvs) & (weights > 0)
+        if not np.any(good):
+            combined[key] = {'rv': rvs, 'weight': weights, 'RV': np.nan, 'error': np.nan}
+            continue
+        wi = weights[good] / weights[good].sum()
+        RV = np.sum(wi * rvs[good])
+        error = np.sqrt(np.sum(wi * (rvs[good] - RV) ** 2) / max(good.sum() - 1, 1))
+        combined[key] = {'rv': rvs, 'weight': weights, 'RV': float(RV), 'error': float(error)}
+    return combined
+
+
+def measure_rv(fname, references, ccf='both', ccf_method='direct',
+               ftype='1D', fitsext='0', order='77', rvmin=0, rvmax=200, drv=1,
+               norm='top50'):
+    """Load, normalize and calculate the CCF of a spectrum without plotting
+
+    :fname: Input spectrum
+    :references: Dictionary with full sun, model, and/or telluric spectra
+    (already loaded, e.g. once per process)
+    :ccf: Calculate CCF for (sun, model, telluric, both)
+    :ccf_method: Method for the CCF (direct, fft, adaptive, bank)
+    :ftype: Type of fits file (1D, CRIRES, GIANO)
+    :fitsext: Fits extention to use
+    :order: GIANO order
+    :rvmin: The lowest RV
+    :rvmax: The highest RV
+    :drv: The velocity step
+    :norm: Normalization of the spectrum (top50, continuum, median)
+    :returns: Dictionary with the output of ccf_astro (and the fitted gaussian)
+    for each template, and a dictionary with the timings in seconds
+    """
+    t0 = time.time()
+    w, I = read_spectrum(fname, ftype=ftype, fitsext=fitsext, order=order)
+    I = normalize(w, I, method=norm)
+    t1 = time.time()
+    templates = _templates(w, I, references, ccf=ccf, ccf_method=ccf_method)
+    results = ccf_templates((w, -I + 1), templates, ccf_method, rvmin, rvmax,
+                            drv, full=True)
+    t2 = time.time()
+    return results, {'read': t1 - t0, 'ccf': t2 - t1}
+
+
+def _parser(gui=False):
     """Take care of all the argparse stuff.
 
+    :gui: Use the Gooey GUI instead of the command line (gooey is only
+    imported here)
     :returns: the args
     """
-    parser = GooeyParser(description='Plot 1D fits files with wavelength information in the header.')
+    if gui:
+        from gooey import Gooey, GooeyParser
+        return Gooey(program_name='Plot fits - Easy 1D fits plotting',
+                     default_size=(610, 730))(_parse_args)(GooeyParser)
+    return _parse_args(argparse.ArgumentParser)
+
+
+def _parse_args(parser_class):
+    """Build the parser with either argparse or Gooey and parse the args"""
+    gui = parser_class is not argparse.ArgumentParser
+
+    def widget(name):
+        return {'widget': name} if gui else {}
+
+    parser = parser_class(description='Plot 1D fits files with wavelength information in the header.')
     parser.add_argument('fname',
-                        action='store',
-                        widget='FileChooser',
-                        help='Input fits file')
+                        nargs='+',
+                        help='Input fits file(s). With several files the plots'
+                        ' are saved in the --output folder',
+                        **widget('MultiFileChooser'))
     parser.add_argument('-m', '--model',
                         default=False,
-                        widget='FileChooser',
                         help='If not the Sun shoul be used as a model, put'
                         ' the model here (only support BT-Settl for the'
-                        ' moment)',)
+                        ' moment)',
+                        **widget('FileChooser'))
+    parser.add_argument('--model-cache',
+                        help='Size limit in MB of the cache with models in'
+                        ' ~/.plotfits/models/ (0 disables the cache)',
+                        default=_MODEL_CACHE_SIZE,
+                        type=float)
     parser.add_argument('-s', '--sun',
                         help='Over plot solar spectrum',
                         action='store_true')
@@ -286,21 +1684,100 @@ def _parser():
                         type=float)
     parser.add_argument('-c', '--ccf',
                         default='none',
-                        choices=['none', 'sun', 'model', 'telluric', 'both'],
+                        choices=['none', 'sun', 'model', 'telluric', 'both', 'mask'],
                         help='Calculate the CCF for Sun/model or tellurics '
-                        'or both.')
+                        'or both, or with the line mask from --linelist.')
+    parser.add_argument('--store',
+                        default=False,
+                        help='Keep the CCFs in this SQLite file and reuse them'
+                        ' when the same spectrum is run again with the same'
+                        ' parameters',
+                        **widget('FileSaver'))
+    parser.add_argument('--linelist',
+                        default=False,
+                        help='Line list for the line mask CCF (MOOG format'
+                        ' from numpy2moog/linelist_filter or .dat from'
+                        ' VALDprepare)',
+                        **widget('FileChooser'))
+    parser.add_argument('--ccf-method',
+                        default='direct',
+                        choices=['direct', 'fft', 'adaptive', 'bank'],
+                        help='Calculate the CCF directly on the RV grid, '
+                        'with an FFT on a log-lambda grid, with a '
+                        'coarse-to-fine search, or with a bank of shifted '
+                        'templates kept in ~/.plotfits/bank/.')
+    parser.add_argument('--rvmin',
+                        help='The lowest RV for the CCF in km/s',
+                        default=0,
+                        type=float)
+    parser.add_argument('--rvmax',
+                        help='The highest RV for the CCF in km/s',
+                        default=200,
+                        type=float)
+    parser.add_argument('--drv',
+                        help='The velocity step for the CCF in km/s',
+                        default=1,
+                        type=float)
+    parser.add_argument('--norm',
+                        default='top50',
+                        choices=['top50', 'continuum', 'median'],
+                        help='Normalization of the spectrum: constant continuum'
+                        ' from the highest points, a spline through the upper'
+                        ' percentile of chunks (sloped continua), or median')
     parser.add_argument('--ftype', help='Select which type the fits file is',
                         choices=['1D', 'CRIRES', 'GIANO'], default='1D')
     parser.add_argument('--fitsext', help='Select fits extention, Default 0.',
                         choices=['0', '1', '2', '3', '4'], default='0')
-    parser.add_argument('--order', help='Select which GIANO order to be investigated',
-                        choices=map(str, range(32,81)), default='77')
+    parser.add_argument('--order', help='Select which GIANO order to be investigated'
+                        ' ("all" calculates the CCF of every order and the'
+                        ' weighted RV, "merged" merges all orders)',
+                        choices=list(map(str, range(32, 81))) + ['all', 'merged'], default='77')
+    parser.add_argument('--save-merged',
+                        default=False,
+                        help='With --order merged, also write the merged 1D'
+                        ' spectrum to this fits file (e.g. for ARES). With'
+                        ' several input files, the folder for the merged'
+                        ' spectra',
+                        **widget('FileSaver'))
+    parser.add_argument('-o', '--output',
+                        default=False,
+                        help='Save the plot to this file (png, pdf, ...)'
+                        ' instead of showing it. With several input files,'
+                        ' the folder for the plots')
+    parser.add_argument('--format',
+                        default='png',
+                        choices=['png', 'pdf', 'svg', 'eps'],
+                        help='Format of the plots with several input files')
+    if not gui:
+        parser.add_argument('--gui',
+                            action='store_true',
+                            help='Use the Gooey GUI (needs gooey)')
+        parser.add_argument('--import-time',
+                            action='store_true',
+                            help='Measure the time of "import plot_fits" and'
+                            ' compare it with the budget of {0!s}s'.format(_IMPORT_TIME_BUDGET))
     return parser.parse_args()
 
 
+def import_time(n=5):
+    """Measure the time of 'import plot_fits' in a fresh interpreter
+
+    :n: Number of measurements (the fastest is used)
+    :returns: The import time in seconds
+    """
+    import subprocess
+    code = 'import time; t = time.time(); import plot_fits; print(time.time() - t)'
+    path = os.path.dirname(os.path.abspath(__file__))
+    return min(float(subprocess.check_output([sys.executable, '-c', code], cwd=path))
+               for _ in range(n))
+
+
 def main(fname, lines=False, model=False, telluric=False, sun=False,
-         rv=False, rv1=False, rv2=False, ccf='none', ftype='1D',
-         fitsext='0', order='77'):
+         rv=False, rv1=False, rv2=False, ccf='none', ccf_method='direct',
+         rvmin=0, rvmax=200, drv=1, model_cache=_MODEL_CACHE_SIZE,
+         norm='top50', ftype='1D', fitsext='0', order='77', output=False,
+         data=False, linelist=False, store=False, references=None,
+         save_merged=False):
     """Plot a fits file with extensive options
 
     :fname: Input spectra
@@ -311,81 +1788,76 @@ def main(fname, lines=False, model=False, telluric=False, sun=False,
     :rv: RV of input spectrum
     :rv1: RV of Solar/model spectrum
     :rv2: RV of telluric spectrum
-    :ccf: Calculate CCF (sun, model, telluric, both)
+    :ccf: Calculate CCF (sun, model, telluric, both, mask)
+    :ccf_method: Method for the CCF (direct, fft, adaptive, bank)
+    :rvmin: The lowest RV for the CCF
+    :rvmax: The highest RV for the CCF
+    :drv: The velocity step for the CCF
+    :model_cache: Size limit of the model cache in MB (0 disables the cache)
+    :norm: Normalization of the spectrum (top50, continuum, median)
     :ftype: Type of fits file (1D, CRIRES, GIANO)
     :fitsext: Slecet fits extention to use (0,1,2,3,4)
-    :returns: RV if CCF have been calculated
+    :order: GIANO order ('all' calculates the CCF of every order and returns
+    the output of rv_orders, 'merged' merges all orders)
+    :output: Save the plot to this file (png, pdf, ...) with a non-interactive
+    backend instead of showing it
+    :data: Do not plot (and do not import pyplot), but return the processed
+    spectra and CCFs
+    :linelist: Line list for the line mask CCF (ccf='mask')
+    :store: Keep the CCFs in this SQLite file (see rvstore), and use the
+    stored CCFs if this spectrum was calculated with the same parameters
+    :references: The full reference spectra from load_references (e.g. kept
+    by spectrum_server), instead of reading them for this spectrum
+    :save_merged: Write the merged GIANO orders (order='merged') to this 1D
+    fits file, e.g. for ARES
+    :returns: RV if CCF have been calculated. If data is True a dictionary
+    with the RVs, the spectra (star, sun, model, telluric) and the CCFs
     """
     print('\n-----------------------------------')
-    path = os.path.expanduser('~/.plotfits/')
-    pathsun = os.path.join(path, 'solarspectrum_01.fits')
-    pathtel = os.path.join(path, 'telluric_NIR.fits')
-    pathwave = os.path.join(path, 'WAVE_PHOENIX-ACES-AGSS-COND-2011.fits')
-    pathGIANO = os.path.join(path, 'wavelength_GIANO.dat')
-    if os.path.isdir(path):
-        if sun and (not os.path.isfile(pathsun)):
-            print('Downloading solar spectrum...')
-            _download_spec(pathsun)
-        if telluric and (not os.path.isfile(pathtel)):
-            print('Downloading telluric spectrum...')
-            _download_spec(pathtel)
-        if model and (not os.path.isfile(pathwave)):
-            print('Downloading wavelength vector for model...')
-            url = 'ftp://phoenix.astro.physik.uni-goettingen.de/HiResFITS//WAVE_PHOENIX-ACES-AGSS-COND-2011.fits'
-            urllib.urlretrieve(url, pathwave)
-    else:
-        os.mkdir(path)
-        print('{0!s} Created'.format(path))
-        print('Downloading solar spectrum...')
-        _download_spec(pathsun)
-        print('Downloading telluric spectrum...')
-        _download_spec(pathtel)
+    if ftype == 'GIANO' and str(order) == 'all':
+        orders, w, I = read_giano_orders(fname)
+        if references is None:
+            references = load_references(sun=sun and not model, telluric=telluric,
+                                          model=model, model_cache=model_cache,
+                                          linelist=ccf == 'mask' and linelist)
+        print('Calculating CCF for {0:d} orders...'.format(len(orders)))
+        results = rv_orders(w, I, references, ccf=ccf, ccf_method=ccf_method,
+                            rvmin=rvmin, rvmax=rvmax, drv=drv, norm=norm)
+        for key in results:
+            print('\nCCF ({0!s})\norder\tRV\tweight'.format(key))
+            for order, rvi, weight in zip(orders, results[key]['rv'], results[key]['weight']):
+                print('{0:d}\t{1:.2f}\t{2:.3g}'.format(order, rvi, weight))
+            print('Weighted RV: {0:.3f} +/- {1:.3f} km/s'.format(results[key]['RV'], results[key]['error']))
+        return results
+
+    if save_merged:
+        if ftype == 'GIANO' and str(order) == 'merged':
+            _, w, I = read_giano_orders(fname)
+            write_spectrum(save_merged, *merge_orders(w, I))
+            print('Merged spectrum written to: {0!s}'.format(save_merged))
+        else:
+            print('Warning: Only the merged GIANO orders (--ftype GIANO --order merged) can be saved')
 
-    fitsext = int(fitsext)
-    order = int(order)
+    if references is None:
+        paths = get_references(sun=sun, telluric=telluric, model=model)
 
-    if ftype == '1D':
-        I = fits.getdata(fname, fitsext)
-        hdr = fits.getheader(fname, fitsext)
-        w = get_wavelength(hdr)
-    elif ftype == 'CRIRES':
-        d = fits.getdata(fname, fitsext)
-        hdr = fits.getheader(fname, fitsext)
-        try:
-            I = d['Extracted_OPT'] # Gasgano reduction
-        except:
-            I = d['Extracted_DRACS'] # Dracs reduction
-        w = d['Wavelength']*10
-    elif ftype == 'GIANO':
-        d = fits.getdata(fname)
-        I = d[order - 32]  # 32 is the first order
-        wd = np.loadtxt(pathGIANO)
-        w1, w2 = wd[wd[:, 0] == order][0][1:]
-        w = np.linspace(w1, w2, len(I))
-
-    I /= np.median(I)
-    # Normalization (use first 50 points below 1.2 as constant continuum)
-    maxes = I[(I < 1.2)].argsort()[-50:][::-1]
-    I /= np.median(I[maxes])
-    dw = 10  # Some extra coverage for RV shifts
+    w, I = read_spectrum(fname, ftype=ftype, fitsext=fitsext, order=order)
+    I = normalize(w, I, method=norm)
 
     if rv:
-        I, w = dopplerShift(wvl=w, flux=I, v=rv, fill_value=0.95)
-    w0, w1 = w[0] - dw, w[-1] + dw
+        I, _ = dopplerShift(wvl=w, flux=I, v=rv, fill_value=0.95)
+    w0, w1 = _template_range(w, ccf_method)
 
     if sun and not model:
-        I_sun = fits.getdata(pathsun)
-        hdr = fits.getheader(pathsun)
-        w_sun = get_wavelength(hdr)
-        i = (w_sun > w0) & (w_sun < w1)
-        w_sun = w_sun[i]
-        I_sun = I_sun[i]
+        if references is None:
+            w_sun, I_sun = _window(read_reference(paths['sun'], w0, w1), w0, w1)
+        else:
+            w_sun, I_sun = _window(references['sun'], w0, w1)
         if len(w_sun) > 0:
-            I_sun /= np.median(I_sun)
             if ccf in ['sun', 'both'] and rv1:
                 print('Warning: RV set for Sun. Calculate RV with CCF')
             if rv1 and ccf not in ['sun', 'both']:
-                I_sun, w_sun = dopplerShift(wvl=w_sun, flux=I_sun, v=rv1, fill_value=0.95)
+                I_sun, _ = dopplerShift(wvl=w_sun, flux=I_sun, v=rv1, fill_value=0.95)
         else:
             print('Warning: Solar spectrum not available in wavelength range.')
             sun = False
@@ -394,126 +1866,171 @@ def main(fname, lines=False, model=False, telluric=False, sun=False,
         sun = False
 
     if model:
-        I_mod = fits.getdata(model)
-        hdr = fits.getheader(model)
-        if 'WAVE' in hdr.keys():
-            w_mod = fits.getdata(pathwave)
+        if references is None:
+            w_mod, I_mod = _window(read_model(model, paths['wave'], cache_size=model_cache),
+                                   w0, w1, continuum=True)
         else:
-            w_mod = get_wavelength(hdr)
-        nre = nrefrac(w_mod)  # Correction for vacuum to air (ground based)
-        w_mod = w_mod / (1 + 1e-6 * nre)
-        i = (w_mod > w0) & (w_mod < w1)
-        w_mod = w_mod[i]
-        I_mod = I_mod[i]
+            w_mod, I_mod = _window(references['model'], w0, w1, continuum=True)
         if len(w_mod) > 0:
-            # https://phoenix.ens-lyon.fr/Grids/FORMAT
-            # I_mod = 10 ** (I_mod-8.0)
-            I_mod /= np.median(I_mod)
-            # Normalization (use first 50 points below 1.2 as continuum)
-            maxes = I_mod[(I_mod < 1.2)].argsort()[-50:][::-1]
-            I_mod /= np.median(I_mod[maxes])
             if ccf in ['model', 'both'] and rv1:
                 print('Warning: RV set for model. Calculate RV with CCF')
             if rv1 and ccf not in ['model', 'both']:
-                I_mod, w_mod = dopplerShift(wvl=w_mod, flux=I_mod, v=rv1, fill_value=0.95)
+                I_mod, _ = dopplerShift(wvl=w_mod, flux=I_mod, v=rv1, fill_value=0.95)
         else:
             print('Warning: Model spectrum not available in wavelength range.')
             model = False
 
     if telluric:
-        I_tel = fits.getdata(pathtel)
-        hdr = fits.getheader(pathtel)
-        w_tel = get_wavelength(hdr)
-        i = (w_tel > w0) & (w_tel < w1)
-        w_tel = w_tel[i]
-        I_tel = I_tel[i]
+        if references is None:
+            w_tel, I_tel = _window(read_reference(paths['telluric'], w0, w1), w0, w1)
+        else:
+            w_tel, I_tel = _window(references['telluric'], w0, w1)
         if len(w_tel) > 0:
-            I_tel /= np.median(I_tel)
             if ccf in ['telluric', 'both'] and rv2:
                 print('Warning: RV set for telluric, Calculate RV with CCF')
             if rv2 and ccf not in ['telluric', 'both']:
-                I_tel, w_tel = dopplerShift(wvl=w_tel, flux=I_tel, v=rv2, fill_value=0.95)
+                I_tel, _ = dopplerShift(wvl=w_tel, flux=I_tel, v=rv2, fill_value=0.95)
         else:
             print('Warning: Telluric spectrum not available in wavelength range.')
             telluric = False
 
     rvs = {}
     if ccf != 'none':
+        templates = {}
         if ccf in ['sun', 'both'] and sun:
             # remove tellurics from the Solar spectrum
             if telluric and sun:
                 print('Correcting solar spectrum for tellurics...')
                 I_sun = I_sun / I_tel
-            print('Calculating CCF for the Sun...')
-            rv1, r_sun, c_sun, x_sun, y_sun = ccf_astro((w, -I + 1), (w_sun, -I_sun + 1))
+            templates['sun'] = (w_sun, -I_sun + 1)
+        if ccf in ['model', 'both'] and model:
+            templates['model'] = (w_mod, -I_mod + 1)
+        if ccf in ['telluric', 'both'] and telluric:
+            templates['telluric'] = (w_tel, -I_tel + 1)
+        if ccf == 'mask':
+            if references is not None and 'mask' in references:
+                templates['mask'] = references['mask']
+            elif linelist:
+                templates['mask'] = read_linemask(linelist)
+            else:
+                print('Warning: A line list (--linelist) is needed for the mask CCF')
+
+        def compute():
+            print('Calculating CCF for: {0!s}...'.format(', '.join(templates)))
+            return ccf_templates((w, -I + 1), templates, ccf_method, rvmin,
+                                 rvmax, drv, full=True)
+
+        if store:
+            import rvstore
+            results, stored = rvstore.cached_ccf(
+                rvstore.connect(store), fname, list(templates), compute,
+                ccf_method=ccf_method, rvmin=rvmin, rvmax=rvmax, drv=drv,
+                norm=norm, ftype=ftype, fitsext=fitsext, order=order,
+                model=model, linelist=linelist, telluric=bool(telluric), rv=rv)
+            if stored:
+                print('Using the stored CCF for: {0!s}'.format(', '.join(results)))
+        else:
+            results = compute()
+        results = {key: results[key][:5] for key in results}
+
+        if 'sun' in results:
+            rv1, r_sun, c_sun, x_sun, y_sun = results['sun']
             if rv1 != 0:
                 print('Shifting solar spectrum...')
-                I_sun, w_sun = dopplerShift(w_sun, I_sun, v=rv1, fill_value=0.95)
+                I_sun, _ = dopplerShift(w_sun, I_sun, v=rv1, fill_value=0.95)
                 rvs['sun'] = rv1
                 print('DONE')
 
-        if ccf in ['model', 'both'] and model:
-            print('Calculating CCF for the model...')
-            rv1, r_mod, c_mod, x_mod, y_mod = ccf_astro((w, -I + 1), (w_mod, -I_mod + 1))
+        if 'model' in results:
+            rv1, r_mod, c_mod, x_mod, y_mod = results['model']
             if rv1 != 0:
                 print('Shifting model spectrum...')
-                I_mod, w_mod = dopplerShift(w_mod, I_mod, v=rv1, fill_value=0.95)
+                I_mod, _ = dopplerShift(w_mod, I_mod, v=rv1, fill_value=0.95)
                 rvs['model'] = rv1
                 print('DONE')
 
-        if ccf in ['telluric', 'both'] and telluric:
-            print('Calculating CCF for the model...')
-            rv2, r_tel, c_tel, x_tel, y_tel = ccf_astro((w, -I + 1), (w_tel, -I_tel + 1))
+        if 'telluric' in results:
+            rv2, r_tel, c_tel, x_tel, y_tel = results['telluric']
             if rv2 != 0:
                 print('Shifting telluric spectrum...')
-                I_tel, w_tel = dopplerShift(w_tel, I_tel, v=rv2, fill_value=0.95)
+                I_tel, _ = dopplerShift(w_tel, I_tel, v=rv2, fill_value=0.95)
                 rvs['telluric'] = rv2
                 print('DONE')
 
+        if 'mask' in results:
+            rv1, r_mask, c_mask, x_mask, y_mask = results['mask']
+            if rv1 != 0:
+                rvs['mask'] = rv1
+
+    if data:
+        out = {'rvs': rvs, 'star': (w, I)}
+        if sun:
+            out['sun'] = (w_sun, I_sun)
+        if model:
+            out['model'] = (w_mod, I_mod)
+        if telluric:
+            out['telluric'] = (w_tel, I_tel)
+        if ccf != 'none':
+            out['ccf'] = {key: results[key][1:] for key in results}
+        return out
+
     if len(rvs) == 0:
         ccf = 'none'
 
+    if output:
+        # No GUI backend (and no pyplot) when saving to a file
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        fig = Figure(figsize=(16, 5))
+        FigureCanvasAgg(fig)
+    else:
+        import matplotlib.pyplot as plt
+        fig = plt.figure(figsize=(16, 5))
+
     if ccf != 'none':
         from matplotlib.gridspec import GridSpec
-        fig = plt.figure(figsize=(16, 5))
         gs = GridSpec(1, 5)
         if len(rvs) == 1:
             gs.update(wspace=0.25, hspace=0.35, left=0.05, right=0.99)
-            ax1 = plt.subplot(gs[:, 0:-1])
-            ax2 = plt.subplot(gs[:, -1])
+            ax1 = fig.add_subplot(gs[:, 0:-1])
+            ax2 = fig.add_subplot(gs[:, -1])
             ax2.set_yticklabels([])
         elif len(rvs) == 2:
             gs.update(wspace=0.25, hspace=0.35, left=0.01, right=0.99)
-            ax1 = plt.subplot(gs[:, 1:4])
-            ax2 = plt.subplot(gs[:, 0])
-            ax3 = plt.subplot(gs[:, -1])
+            ax1 = fig.add_subplot(gs[:, 1:4])
+            ax2 = fig.add_subplot(gs[:, 0])
+            ax3 = fig.add_subplot(gs[:, -1])
             ax2.set_yticklabels([])
             ax3.set_yticklabels([])
     else:
-        fig = plt.figure(figsize=(16, 5))
         ax1 = fig.add_subplot(111)
 
-    # Start in pan mode with these two lines
-    manager = plt.get_current_fig_manager()
-    manager.toolbar.pan()
+    if not output:
+        # Start in pan mode with these two lines
+        manager = plt.get_current_fig_manager()
+        manager.toolbar.pan()
 
     # Use nice numbers on x axis (y axis is normalized)...
-    x_formatter = matplotlib.ticker.ScalarFormatter(useOffset=False)
+    from matplotlib.ticker import ScalarFormatter
+    x_formatter = ScalarFormatter(useOffset=False)
     ax1.xaxis.set_major_formatter(x_formatter)
 
+    # Keep a reference to the lines, so they can update on zoom/pan
+    spectra = []
     if sun and not model:
-        ax1.plot(w_sun, I_sun, '-g', lw=2, alpha=0.6, label='Sun')
+        spectra.append(DecimatedLine(ax1, w_sun, I_sun, '-g', lw=2, alpha=0.6, label='Sun'))
     if telluric:
-        ax1.plot(w_tel, I_tel, '-r', lw=2, alpha=0.5, label='Telluric')
+        spectra.append(DecimatedLine(ax1, w_tel, I_tel, '-r', lw=2, alpha=0.5, label='Telluric'))
     if model:
-        ax1.plot(w_mod, I_mod, '-g', lw=2, alpha=0.5, label='Model')
-    ax1.plot(w, I, '-k', lw=2, label='Star')
+        spectra.append(DecimatedLine(ax1, w_mod, I_mod, '-g', lw=2, alpha=0.5, label='Model'))
+    spectra.append(DecimatedLine(ax1, w, I, '-k', lw=2, label='Star'))
 
-    # Add crosshair
-    xlim = ax1.get_xlim()
-    cursor = Cursor(ax1)
-    plt.connect('motion_notify_event', cursor.mouse_move)
-    ax1.set_xlim(xlim)
+    if not output:
+        # Add crosshair
+        xlim = ax1.get_xlim()
+        cursor = Cursor(ax1)
+        plt.connect('motion_notify_event', cursor.mouse_move)
+        ax1.set_xlim(xlim)
 
     if lines:
         y0, y1 = ax1.get_ylim()
@@ -543,6 +2060,10 @@ def main(fname, lines=False, model=False, telluric=False, sun=False,
             ax2.plot(r_tel, c_tel, '-k', lw=2)
             ax2.plot(x_tel, y_tel, '--r', lw=2)
             ax2.set_title('CCF (tel)')
+        if 'mask' in rvs.keys():
+            ax2.plot(r_mask, c_mask, '-k', lw=2)
+            ax2.plot(x_mask, y_mask, '--r', lw=2)
+            ax2.set_title('CCF (mask)')
         ax2.set_xlabel('RV [km/s]')
 
     elif len(rvs) == 2:
@@ -575,20 +2096,66 @@ def main(fname, lines=False, model=False, telluric=False, sun=False,
         ax1.set_title('{0!s}\nSun(CCF): {1!s} km/s'.format(fname, rv1))
     elif ccf == 'telluric':
         ax1.set_title('{0!s}\nTelluric(CCF): {1!s} km/s'.format(fname, rv2))
+    elif ccf == 'mask':
+        ax1.set_title('{0!s}\nLine mask(CCF): {1!s} km/s'.format(fname, rv1))
     elif ccf == 'both':
         ax1.set_title('{0!s}\nSun/model(CCF): {1!s} km/s, telluric(CCF): {2!s} km/s'.format(fname, rv1, rv2))
     else:
         ax1.set_title(fname)
     if sun or telluric or model:
         ax1.legend(loc=3, frameon=False)
-    plt.show()
+    if output:
+        fig.savefig(output)
+        print('Plot saved in {0!s}'.format(output))
+    else:
+        plt.show()
 
     return rvs
 
 
+def render(fnames, outdir='.', fmt='png', **kwargs):
+    """Plot many fits files to png/pdf files without a display
+
+    :fnames: Input spectra
+    :outdir: Folder for the plots
+    :fmt: Format of the plots (png, pdf, ...)
+    :kwargs: Other keywords for main (sun, telluric, model, ccf, ...). The
+    folder for the merged spectra is given as save_merged, and they are
+    saved as "<name>_merged.fits"
+    :returns: Dictionary with the RVs of each input spectrum
+    """
+    save_merged = kwargs.pop('save_merged', False)
+    for folder in (outdir, save_merged):
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+    rvs = {}
+    for fname in fnames:
+        name = os.path.basename(fname).rpartition('.')[0] or os.path.basename(fname)
+        output = os.path.join(outdir, '{0!s}.{1!s}'.format(name, fmt))
+        if save_merged:
+            kwargs['save_merged'] = os.path.join(save_merged, '{0!s}_merged.fits'.format(name))
+        rvs[fname] = main(fname, output=output, **kwargs)
+    return rvs
+
+
 if __name__ == '__main__':
-    args = vars(_parser())
-    fname = args.pop('fname')
+    if '--import-time' in sys.argv:
+        t = import_time()
+        print('import plot_fits: {0:.3f}s (budget: {1!s}s)'.format(t, _IMPORT_TIME_BUDGET))
+        raise SystemExit(t > _IMPORT_TIME_BUDGET)
+
+    # Gooey runs the script again with --ignore-gooey
+    gui = '--gui' in sys.argv or '--ignore-gooey' in sys.argv
+    if '--gui' in sys.argv:
+        sys.argv.remove('--gui')
+    args = vars(_parser(gui=gui))
+    args.pop('gui', None)
+    args.pop('import_time', None)
+    fnames = args.pop('fname')
+    fmt = args.pop('format')
     opts = {k: args[k] for k in args}
 
-    main(fname, **opts)
+    if len(fnames) == 1:
+        main(fnames[0], **opts)
+    else:
+        render(fnames, outdir=opts.pop('output') or '.', fmt=fmt, **opts)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+# My imports
+from __future__ import division, print_function
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import argparse
+import numpy as np
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY, size INTEGER, mtime REAL, sha1 TEXT,
+    object TEXT, date TEXT);
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY, sha1 TEXT, fname TEXT, object TEXT, date TEXT,
+    template TEXT, params TEXT, rv REAL, amplitude REAL, center REAL,
+    sigma REAL, drvs BLOB, ccf BLOB, created REAL);
+CREATE INDEX IF NOT EXISTS results_object ON results (object, date);
+CREATE INDEX IF NOT EXISTS results_date ON results (date);
+CREATE INDEX IF NOT EXISTS results_sha1 ON results (sha1);
+'''
+
+
+def connect(fname='rv_results.sqlite'):
+    """Open (and create) a store with RV results
+
+    :fname: The SQLite file
+    :returns: The connection
+    """
+    db = sqlite3.connect(fname, timeout=60)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.executescript(_SCHEMA)
+    return db
+
+
+def _header_info(fname):
+    """The object and date of observation from the primary header"""
+    from astropy.io import fits
+    try:
+        hdr = fits.getheader(fname)
+    except Exception:
+        return None, None
+    date = hdr.get('DATE-OBS', hdr.get('DATE'))
+    return hdr.get('OBJECT'), None if date is None else str(date)
+
+
+def file_info(db, fname):
+    """The sha1 of the content of a file, and its object and date. The hash
+    is only calculated again if the size or time of modification changed
+
+    :db: The store
+    :fname: The input spectrum
+    :returns: The sha1, object, and date
+    """
+    path = os.path.abspath(fname)
+    size, mtime = os.path.getsize(path), os.path.getmtime(path)
+    row = db.execute('SELECT sha1, object, date FROM files WHERE path=? AND size=? AND mtime=?',
+                     (path, size, mtime)).fetchone()
+    if row:
+        return row
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            sha1.update(block)
+    sha1 = sha1.hexdigest()
+    obj, date = _header_info(path)
+    with db:
+        db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                   (path, size, mtime, sha1, obj, date))
+    return sha1, obj, date
+
+
+def result_key(sha1, template, **params):
+    """The key of a result: the hash of the input file, the template and the
+    CCF parameters (e.g. rvmin, rvmax, drv, ccf_method, norm, ftype, fitsext,
+    order)
+
+    :sha1: The sha1 of the input file
+    :template: The template (sun, model, telluric, mask)
+    :params: The CCF parameters
+    :returns: The key and the parameters as JSON
+    """
+    params = json.dumps(params, sort_keys=True, default=str)
+    key = hashlib.sha1('{0!s}|{1!s}|{2!s}'.format(sha1, template, params).encode('utf-8'))
+    return key.hexdigest(), params
+
+
+def get_result(db, key):
+    """A stored result
+
+    :db: The store
+    :key: The key from result_key
+    :returns: None if not stored, otherwise a dictionary with the rv,
+    amplitude, center, sigma, and the CCF (drvs, ccf)
+    """
+    row = db.execute('SELECT rv, amplitude, center, sigma, drvs, ccf FROM results WHERE key=?',
+                     (key,)).fetchone()
+    if row is None:
+        return None
+    rv, amplitude, center, sigma, drvs, ccf = row
+    return {'rv': rv, 'amplitude': amplitude, 'center': center, 'sigma': sigma,
+            'drvs': np.frombuffer(drvs, dtype=float) if drvs else np.array([]),
+            'ccf': np.frombuffer(ccf, dtype=float) if ccf else np.array([])}
+
+
+def put_result(db, key, params, fname, sha1, obj, date, template, rv,
+               amplitude, center, sigma, drvs, ccf):
+    """Store a result (replacing an older one with the same key)
+
+    :db: The store
+    :key: The key from result_key
+    :params: The CCF parameters as JSON from result_key
+    :fname: The input spectrum
+    :sha1: The sha1 of the input file
+    :obj: The object
+    :date: The date of observation
+    :template: The template (sun, model, telluric, mask)
+    :rv: The RV
+    :amplitude: The amplitude of the gaussian fitted to the CCF
+    :center: The center of the gaussian
+    :sigma: The width of the gaussian
+    :drvs: The RV grid of the CCF
+    :ccf: The (normalized) CCF
+    """
+    drvs = np.asarray(drvs, dtype=float).tobytes()
+    ccf = np.asarray(ccf, dtype=float).tobytes()
+    with db:
+        db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                   (key, sha1, os.path.abspath(fname), obj, date, template, params,
+                    rv, amplitude, center, sigma, drvs, ccf, time.time()))
+
+
+def cached_ccf(db, fname, templates, compute, **params):
+    """The CCFs of a spectrum from the store, or calculated and stored if
+    any of the templates is missing
+
+    :db: The store
+    :fname: The input spectrum
+    :templates: The templates expected in the results
+    :compute: Function calculating the CCFs, returning a dictionary with the
+    output of plot_fits.ccf_templates(..., full=True)
+    :params: The CCF parameters for the key (see result_key)
+    :returns: A dictionary like the one from compute, and whether it was
+    found in the store
+    """
+    from plot_fits import Gaussian, gaussian_parameters
+    sha1, obj, date = file_info(db, fname)
+    keys = {template: result_key(sha1, template, **params) for template in templates}
+    stored = {template: get_result(db, keys[template][0]) for template in templates}
+    if templates and all(r is not None for r in stored.values()):
+        results = {}
+        for template, r in stored.items():
+            if not len(r['drvs']):
+                results[template] = (0, 0, 0, 0, 0, None)
+                continue
+            g = Gaussian(r['amplitude'], r['center'], r['sigma'])
+            results[template] = (int(r['rv']), r['drvs'], r['ccf'], r['drvs'], g(r['drvs']), g)
+        return results, True
+
+    results = compute()
+    for template, (RV, drvs, ccf, _, _, g) in results.items():
+        key, params_json = keys.get(template) or result_key(sha1, template, **params)
+        if g is None:
+            amplitude, center, sigma, drvs, ccf = np.nan, np.nan, np.nan, [], []
+        else:
+            amplitude, center, sigma = gaussian_parameters(g)
+        put_result(db, key, params_json, fname, sha1, obj, date, template, RV,
+                   amplitude, center, sigma, drvs, ccf)
+    return results, False
+
+
+def query(db, obj=None, date=None, template=None):
+    """The stored results of an object and/or (the start of) a date
+
+    :db: The store
+    :obj: The object
+    :date: The date of observation, or the start of it (e.g. '2016-05')
+    :template: The template
+    :returns: Rows with fname, object, date, template, rv, amplitude, center,
+    sigma
+    """
+    sql = 'SELECT fname, object, date, template, rv, amplitude, center, sigma FROM results'
+    where, args = [], []
+    if obj is not None:
+        where.append('object=?')
+        args.append(obj)
+    if date is not None:
+        # A range instead of LIKE, so the index on date is used
+        where.append('date>=? AND date<?')
+        args += [date, date + '\uffff']
+    if template is not None:
+        where.append('template=?')
+        args.append(template)
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    return db.execute(sql + ' ORDER BY date, fname', args).fetchall()
+
+
+def _parser():
+    parser = argparse.ArgumentParser(description='Show the RVs in a store made'
+                                     ' by plot_fits or batch_rv (--store)')
+    parser.add_argument('store', help='The SQLite file')
+    parser.add_argument('-O', '--object', default=None,
+                        help='Only this object')
+    parser.add_argument('-d', '--date', default=None,
+                        help='Only this date (or the start of it, e.g. 2016-05)')
+    parser.add_argument('-t', '--template', default=None,
+                        help='Only this template (sun, model, telluric, mask)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parser()
+    db = connect(args.store)
+    print('# fname\tobject\tdate\ttemplate\trv\tamplitude\tcenter\tsigma')
+    for row in query(db, args.object, args.date, args.template):
+        print('\t'.join(map(str, row)))
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+# My imports
+from __future__ import division, print_function
+import os
+import json
+import time
+import socket
+import argparse
+
+# The client only needs the modules above, so it starts fast. The server
+# imports plot_fits (and numpy, astropy, scipy, matplotlib) once.
+_SOCKET = os.path.expanduser('~/.plotfits/server.sock')
+_REFERENCES = {}
+
+
+def _references(sun=False, telluric=False, model=False, linelist=False):
+    """The reference spectra, loaded once for each combination"""
+    import plot_fits
+    key = (bool(sun), bool(telluric), model or False, linelist or False)
+    if key not in _REFERENCES:
+        _REFERENCES[key] = plot_fits.load_references(sun=sun, telluric=telluric,
+                                                     model=model, linelist=linelist)
+    return _REFERENCES[key]
+
+
+def _load(fname, ftype='1D', fitsext='0', order='77', w0=None, w1=None,
+          norm=None, data=False):
+    """Read (and normalize) a spectrum"""
+    import numpy as np
+    import plot_fits
+    w, I = plot_fits.read_spectrum(fname, ftype=ftype, fitsext=fitsext,
+                                   order=order, w0=w0, w1=w1)
+    if norm:
+        I = plot_fits.normalize(w, I, method=norm)
+    out = {'fname': fname, 'n': len(w), 'wmin': float(w[0]), 'wmax': float(w[-1]),
+           'median': float(np.median(I))}
+    if data:
+        out['w'], out['I'] = np.asarray(w, dtype=float).tolist(), np.asarray(I, dtype=float).tolist()
+    return out
+
+
+def _normalize(fname, norm='top50', **kwargs):
+    """Read and normalize a spectrum"""
+    return _load(fname, norm=norm, **kwargs)
+
+
+def _ccf(fname, ccf='sun', model=False, linelist=False, **kwargs):
+    """The RV of a spectrum with the references kept in the server"""
+    import plot_fits
+    references = _references(sun=ccf in ['sun', 'both'] and not model,
+                             telluric=ccf in ['telluric', 'both'], model=model,
+                             linelist=ccf == 'mask' and linelist)
+    results, timings = plot_fits.measure_rv(fname, references, ccf=ccf, **kwargs)
+    rvs = {}
+    for key, result in results.items():
+        amplitude, center, sigma = plot_fits.gaussian_parameters(result[-1])
+        rvs[key] = {'rv': result[0], 'amplitude': amplitude, 'center': center, 'sigma': sigma}
+    return {'fname': fname, 'rvs': rvs, 'timings': timings}
+
+
+def _render(fname, output, sun=False, telluric=False, model=False,
+            linelist=False, ccf='none', **kwargs):
+    """Plot a spectrum to a file (like plot_fits -o) with the references kept
+    in the server"""
+    import plot_fits
+    references = _references(sun=sun and not model, telluric=telluric,
+                             model=model, linelist=ccf == 'mask' and linelist)
+    rvs = plot_fits.main(fname, output=output, sun=sun, telluric=telluric,
+                         model=model, linelist=linelist, ccf=ccf,
+                         references=references, **kwargs)
+    return {'fname': fname, 'output': output, 'rvs': rvs}
+
+
+_COMMANDS = {'load': _load,
+             'normalize': _normalize,
+             'ccf': _ccf,
+             'render': _render,
+             'ping': lambda: {'pid': os.getpid()}}
+
+
+def _recv(conn):
+    """Read a JSON message until the other end stops writing"""
+    chunks = []
+    while True:
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return json.loads(b''.join(chunks).decode('utf-8'))
+
+
+def _default(obj):
+    """JSON for numpy numbers and arrays"""
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    raise TypeError('{0!r} is not JSON serializable'.format(obj))
+
+
+def serve(path=_SOCKET):
+    """Run the server: keep plot_fits and the references loaded and answer
+    requests on a Unix socket, one at a time. A request is a JSON object with
+    'command' (load, normalize, ccf, render, ping, stop) and the keywords for
+    it.
+
+    :path: The Unix socket
+    """
+    import plot_fits
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib.backends import backend_agg  # Imported once for render
+
+    if os.path.exists(path):
+        os.remove(path)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(8)
+    print('Listening on {0!s} (pid {1:d})'.format(path, os.getpid()))
+    try:
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                t0 = time.time()
+                try:
+                    request = _recv(conn)
+                    command = request.pop('command')
+                    if command == 'stop':
+                        conn.sendall(json.dumps({'stopped': True}).encode('utf-8'))
+                        break
+                    result = _COMMANDS[command](**request)
+                except Exception as e:
+                    result = {'error': '{0!s}: {1!s}'.format(type(e).__name__, e)}
+                result['time'] = time.time() - t0
+                conn.sendall(json.dumps(result, default=_default).encode('utf-8'))
+    finally:
+        server.close()
+        os.remove(path)
+
+
+def request(command, path=_SOCKET, **kwargs):
+    """Send a request to the server
+
+    :command: load, normalize, ccf, render, ping or stop
+    :path: The Unix socket
+    :kwargs: The keywords for the command
+    :returns: The answer as a dictionary
+    """
+    # The server resolves the files relative to its own working directory
+    for key in ('fname', 'output', 'model', 'linelist'):
+        if kwargs.get(key):
+            kwargs[key] = os.path.abspath(kwargs[key])
+    kwargs['command'] = command
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+        client.sendall(json.dumps(kwargs).encode('utf-8'))
+        client.shutdown(socket.SHUT_WR)
+        return _recv(client)
+    finally:
+        client.close()
+
+
+def _parser():
+    parser = argparse.ArgumentParser(description='Keep plot_fits and the'
+                                     ' reference spectra loaded in a server,'
+                                     ' and send it requests')
+    parser.add_argument('--socket', default=_SOCKET,
+                        help='The Unix socket (default: ~/.plotfits/server.sock)')
+    sub = parser.add_subparsers(dest='command')
+    sub.add_parser('start', help='Run the server')
+    sub.add_parser('stop', help='Stop the server')
+    sub.add_parser('ping', help='Check that the server is running')
+    for command in ('load', 'normalize', 'ccf', 'render'):
+        p = sub.add_parser(command, help='{0!s} a spectrum'.format(command.capitalize()))
+        p.add_argument('fname', help='Input fits file')
+        p.add_argument('--ftype', choices=['1D', 'CRIRES', 'GIANO'], default='1D')
+        p.add_argument('--fitsext', choices=['0', '1', '2', '3', '4'], default='0')
+        p.add_argument('--order', default='77')
+        if command in ('normalize', 'ccf', 'render'):
+            p.add_argument('--norm', choices=['top50', 'continuum', 'median'], default='top50')
+        if command in ('ccf', 'render'):
+            p.add_argument('-c', '--ccf', default='sun',
+                           choices=['sun', 'model', 'telluric', 'both', 'mask'])
+            p.add_argument('-m', '--model', default=False)
+            p.add_argument('--linelist', default=False)
+            p.add_argument('--ccf-method', default='direct',
+                           choices=['direct', 'fft', 'adaptive', 'bank'])
+            p.add_argument('--rvmin', default=0, type=float)
+            p.add_argument('--rvmax', default=200, type=float)
+            p.add_argument('--drv', default=1, type=float)
+        if command == 'render':
+            p.add_argument('-o', '--output', required=True,
+                           help='Save the plot to this file')
+            p.add_argument('-s', '--sun', default=False, action='store_true')
+            p.add_argument('-t', '--telluric', default=False, action='store_true')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = vars(_parser())
+    path, command = args.pop('socket'), args.pop('command')
+    if command == 'start':
+        serve(path)
+    elif command is None:
+        print('Give a command (start, stop, ping, load, normalize, ccf, render)')
+    else:
+        try:
+            answer = request(command, path, **args)
+        except socket.error as e:
+            print('Not able to connect to the server at {0!s} ({1!s}). Start it'
+                  ' with: spectrum_server.py start'.format(path, e))
+            raise SystemExit(1)
+        print(json.dumps(answer, indent=2))
+        raise SystemExit('error' in answer)